@@ -7,13 +7,23 @@ Pure Data and the Heavy compiler.
 This version sonifies only the data pertaining to R Groups. Future iterations will make use 
 of data from protein backbone data as well. 
 
+Run without arguments to be prompted for a single file. Pass files, directories or glob
+patterns to parse them in parallel and play them one after another (see batch.py).
+
 Brian Cantrell, Worldbuilding Media Lab. Sept, 2020.
 """
 from pythonosc import osc_message_builder
 from pythonosc import osc_bundle_builder
 from pythonosc import udp_client
 import os
+import sys
 import time
+import argparse
+import atomtable
+import batch
+import parsecache
+import telemetry
+import profiling
 
 #################################################################################
 # OSC SETUP #####################################################################
@@ -29,20 +39,8 @@ newAAMsg = False
 
 #################################################################################
 #GLOBAL VARIABLES ###############################################################
-# Column indices (WARNING: THESE MIGHT CHANGE ACCORDING TO FILE TYPE)
-BFactorCol = 14 #Column for temperature (B Factor)
-atomCol = 3 # Column for atom name
-AACol = 5 # Column for amino acid label
-chainCol = 8 # Column for the chain number
-asymCol = 6 # Column for the asymmetry chain letter
-entityCol = 7 # Column for the entity number
-
-# Lists to hold the relevant data
-RGroupAAs = [] # List to hold R Group amino acids (used to index hydroVals)
-RGroupChains = [] # List to hold R Group chain numbers (corresponding to amino acid)
-RGroupBFactors = [] # List to hold R Group B factors
-RGroupAsyms = [] # List to hold R Group asym values
-RGroupEntities = [] # List to hold R Group entity values
+# Parsed data
+atoms = None # Columnar table (atomtable.AtomTable) of the R Group atoms
 
 # Variables to hold temp values
 newAsymVal = ' '
@@ -68,6 +66,8 @@ PDBFile = " " # Hold the selected file
 speed = .3 # Global speed for the OSC engine
  # Create an iterator to use for timing
 iterator = 0
+# Tick counters and status output (telemetry.Telemetry)
+stats = telemetry.Telemetry()
 
 # Dictionary of hydrophobicity values
 hydroVals = { 
@@ -94,54 +94,34 @@ hydroVals = {
     }
 
 #################################################################################
-# Open a file
-def openFile(data):
-    file = open(data, 'r')
+# Parse a file into a columnar table of its R Group atoms. Only the ATOM records are
+# streamed from the file and the backbone entries are skipped. Files that were parsed
+# before are loaded from the parse cache instead. Only the given model is read (None for all).
+# With mapped=True mmCIF files are scanned from a memory map (see mmapreader).
+def readTable(data, useCache=True, model=1, mapped=False):
+    if useCache:
+        table = parsecache.readStructure(data, secondaryStructure=False, model=model, mapped=mapped).atoms
+    else:
+        table = atomtable.readStructure(data, secondaryStructure=False, model=model, mapped=mapped).atoms
+    if len(table) == 0:
+        raise ValueError("no side chain ATOM records found")
+    return table
 
+# Open a file. Only the given model is read (None for all). With mapped=True mmCIF files
+# are scanned from a memory map, with useCache=False the parse cache is bypassed.
+def openFile(data, model=1, mapped=False, useCache=True):
     # make global variables visible
-    
-    global RGroupAAs
-    global RGroupBFactors
-    global RGroupAsyms
-    global RGroupEntities
-    global RGroupChains
-    
-    # Clear lists just in case...
-    RGroupAAs.clear()
-    RGroupBFactors.clear()
-    RGroupAsyms.clear()
-    RGroupEntities.clear()
-    RGroupChains.clear()
-    
-    if file is not None:
-        # Split the file up by line
-        theFile = file.readlines()
-         # Loop over file and select for ATOM entries
-        for line in theFile:
-            entry = line.split()
-            # Select for only those lines listing ATOM coordinates
-            if entry[0] == "ATOM":
-                # Ignore the lines with backbone entries
-                atomName = str(entry[atomCol])
-                atomName.strip()
-                
-                if atomName == "CA" or atomName == "C" or atomName == "N" or atomName == "O" or atomName == "CB":
-                    pass
-                # Push R Group amino acid labels and B Factor values to lists
-                else:
-                    #print(atomName)
-                    RGroupAAs.append(entry[AACol])
-                    RGroupBFactors.append(entry[BFactorCol])
-                    RGroupAsyms.append(entry[asymCol])
-                    RGroupEntities.append(entry[entityCol])
-                    RGroupChains.append(entry[chainCol])
-    
-    else:
-        println("file is none")
+    global atoms
+    global iterator
+
+    atoms = readTable(data, useCache, model, mapped)
+    iterator = 0
+    return atoms
     
 #################################################################################
 # Start the OSC engine
 def runOSC():
+    start = time.perf_counter()
     global iterator
     global newAsymVal
     global oldAsymVal
@@ -161,18 +141,18 @@ def runOSC():
     global hydroMsg
 
     # Set B Factor message
-    BFactorMsg = RGroupBFactors[iterator]
-    client.send_message("/BFactor", float(BFactorMsg))
+    BFactorMsg = float(atoms.bfactor[iterator])
+    client.send_message("/BFactor", BFactorMsg)
     # Retrieve hydrophobicity from table by indexing the amino acids list
-    aminoAcid = RGroupAAs[iterator]
+    aminoAcid = atoms.residue(iterator)
     # Set hydrophobicity message
     hydroMsg = hydroVals[aminoAcid]
     # Set new asym message
     # Check if new asym is same as old asym
-    newAsymVal = RGroupAsyms[iterator]
-    newEntityVal = RGroupEntities[iterator]
-    #newAA = RGroupAAs[iterator]
-    newChainVal = RGroupChains[iterator]
+    newAsymVal = atoms.asym(iterator)
+    newEntityVal = int(atoms.entity[iterator])
+    #newAA = atoms.residue(iterator)
+    newChainVal = int(atoms.seqId[iterator])
 
     # New asym logic
     if newAsymVal != oldAsymVal:
@@ -214,25 +194,82 @@ def runOSC():
         pass
     
     # Set BFactor and Hydrophibicity messages
-    print(BFactorMsg)
-    
     client.send_message("/hydrophobicity", hydroMsg)
 
+    # Count the tick. The B Factor is logged by a background thread (see telemetry.py)
+    stats.tick(time.perf_counter() - start, status=BFactorStatus)
+
     # Increment iterator    
     iterator += 1
     # Take modulus to loop back to beginning of lists
-    iterator %= len(RGroupAAs)
+    iterator %= len(atoms)
     # Sleep to control speed
     time.sleep(speed)
 
+def BFactorStatus():
+    return "B Factor: %.2f" % BFactorMsg
+
 #################################################################################
 # Main Loop
 def main():
-    pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
-    openFile(pdbFile)
-    # TODO: Implement better quit code
+    global stats
+    parser = argparse.ArgumentParser(description="Sonify the R Group B factors of PDB files over OSC.")
+    batch.addArguments(parser)
+    parser.add_argument("--check", action="store_true",
+            help="parse the files and report on them without starting the OSC engine")
+    parser.add_argument("--no-cache", action="store_true", help="always reparse the files")
+    parser.add_argument("--mmap", action="store_true",
+            help="parse mmCIF files from a memory map, which needs far less memory for large files")
+    batch.addModelArgument(parser)
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+            help="DEBUG: B factor of every tick, INFO: rate-limited status line (default), "
+                 "WARNING: summary only")
+    profiling.addArguments(parser)
+    args = parser.parse_args()
+    telemetry.setup(args.log_level)
+    stats = telemetry.Telemetry()
+    # Profiling covers the parsing, in this process, and reports before playback starts
+    if profiling.setup(args):
+        args.workers = 1
+
+    # Interactive mode for a single file
+    if not args.paths:
+        pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
+        openFile(pdbFile, model=args.model, mapped=args.mmap, useCache=not args.no_cache)
+        profiling.finish(args.profile)
+        # TODO: Implement better quit code
+        print("Press ctrl+c to quit.")
+        try:
+            while True:
+                runOSC()
+        except KeyboardInterrupt:
+            stats.summary()
+            return
+
+    # Batch mode: parse every file in parallel, then play them one after another
+    global atoms
+    global iterator
+    results = batch.runBatch(readTable, batch.expandPaths(args.paths),
+            (not args.no_cache, args.model, args.mmap), args.workers)
+    profiling.finish(args.profile)
+    playlist = [(result.path, result.value) for result in results if result.error is None]
+    if args.check:
+        for path, table in playlist:
+            print("%s: %d R Group atoms, mean B factor %.2f" % (path, len(table), table.bfactor.mean()))
+        return
+    if not playlist:
+        sys.exit("No R Group atoms to play.")
+
     print("Press ctrl+c to quit.")
-    while True:
-        runOSC()
+    try:
+        while True:
+            for path, table in playlist:
+                telemetry.logger.info("Playing %s", path)
+                atoms = table
+                iterator = 0
+                for _ in range(len(atoms)):
+                    runOSC()
+    except KeyboardInterrupt:
+        stats.summary()
       
 if __name__ == '__main__': main()
@@ -0,0 +1,433 @@
+"""
+Columnar atom table built from the records streamed by cifreader.
+
+Instead of one Python list of strings per column, the parsed atoms are held as typed NumPy
+arrays (site, B factor, coordinates, residue number, entity) and the string columns
+(residue, asym and atom names) are stored as small integer codes into a list of labels.
+Mapping tables such as aaCategories or hydroVals can then be applied to every atom at once
+with a lookup array indexed by the residue codes.
+
+readStructure(..., mapped=True) parses mmCIF files with mmapreader, which scans the
+mapped bytes of the _atom_site loop instead of splitting every line into strings.
+
+aggregateResidues() groups the atoms by residue (asym, residue number) into a ResidueTable
+with one row per residue: its atom count, mean and max B factor and centroid.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+import numpy as np
+import cifindex
+import cifreader
+import mmapreader
+import pdbreader
+import profiling
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Backbone atom names. These are skipped when only the R Groups are wanted.
+BACKBONE = ("CA", "C", "N", "O", "CB")
+
+# Number of rows converted to arrays at a time while streaming
+chunkSize = 65536
+
+# Version of the parsed output. Bump whenever a change to the parser or the table changes
+# what a file parses to, so cached tables are not reused across the change.
+parserVersion = 4
+
+# Residue names of water molecules
+WATERS = ("HOH", "DOD", "WAT")
+
+# seqId of atoms without a residue number (ligands and waters in mmCIF). Author residue
+# numbers of legacy PDB files can be negative, so -1 is a real residue.
+MISSING_SEQ = np.iinfo(np.int32).min
+
+# A parsed file: the R Group atom table, the secondary structure index and the table of
+# HETATM ligand and/or water atoms (None when they were not asked for)
+Structure = namedtuple("Structure", ["atoms", "structIndex", "hetatms"], defaults=(None,))
+
+# AtomTable attributes holding arrays and label lists
+arrayColumns = ("site", "atomCodes", "residueCodes", "asymCodes", "entity", "seqId", "bfactor", "coords")
+labelColumns = ("atomNames", "residues", "asyms")
+
+#################################################################################
+class AtomTable(object):
+    def __init__(self, site, atomCodes, atomNames, residueCodes, residues, asymCodes, asyms,
+            entity, seqId, bfactor, coords):
+        self.site = site                    # int32 site numbers
+        self.atomCodes = atomCodes          # uint16 codes into atomNames
+        self.atomNames = atomNames          # List of atom name labels
+        self.residueCodes = residueCodes    # uint16 codes into residues
+        self.residues = residues            # List of amino acid labels
+        self.asymCodes = asymCodes          # uint16 codes into asyms
+        self.asyms = asyms                  # List of asym chain letters
+        self.entity = entity                # int32 entity numbers
+        self.seqId = seqId                  # int32 residue (chain) numbers
+        self.bfactor = bfactor              # float32 B factors
+        self.coords = coords                # float32 (N, 3) coordinates, (0, 3) when not extracted
+
+    def __len__(self):
+        return len(self.site)
+
+    # The array columns and label lists of the table, e.g. for saving it to disk
+    def arrays(self):
+        arrays = {}
+        for name in arrayColumns:
+            arrays[name] = getattr(self, name)
+        return arrays
+
+    def labels(self):
+        labels = {}
+        for name in labelColumns:
+            labels[name] = list(getattr(self, name))
+        return labels
+
+    # Rebuild a table from the output of arrays() and labels()
+    @classmethod
+    def fromColumns(cls, arrays, labels):
+        columns = dict(arrays)
+        columns.update(labels)
+        return cls(**columns)
+
+    # Label of a single row
+    def residue(self, i):
+        return self.residues[self.residueCodes[i]]
+
+    def asym(self, i):
+        return self.asyms[self.asymCodes[i]]
+
+    def atomName(self, i):
+        return self.atomNames[self.atomCodes[i]]
+
+    # Whether the coordinates were extracted when the file was parsed
+    def hasCoordinates(self):
+        return len(self.coords) == len(self)
+
+    # Map every atom's residue through a dict (e.g. aaCategories or hydroVals) at once.
+    # Residues missing from the mapping raise a KeyError unless a default is given.
+    def mapResidues(self, mapping, default=None, dtype=np.int16):
+        lookup = np.empty(len(self.residues), dtype=dtype)
+        for code, residue in enumerate(self.residues):
+            if residue in mapping:
+                lookup[code] = mapping[residue]
+            elif default is None:
+                raise KeyError(residue)
+            else:
+                lookup[code] = default
+        return lookup[self.residueCodes]
+
+    # Structure type of every atom from a cifreader secondary structure index
+    def structTypes(self, structIndex):
+        types = np.full(len(self), cifreader.STRUCT_LOOP, dtype=np.int8)
+        if len(self) == 0 or not structIndex:
+            return types
+
+        # Atoms without a residue number (e.g. ligands) stay loops
+        valid = self.seqId != MISSING_SEQ
+        if not valid.any():
+            return types
+        seqIds = self.seqId[valid]
+
+        # Lookup array indexed by [asym code, residue number - minSeq]. Residue numbers
+        # can be negative (author numbering of legacy PDB files).
+        asymLookup = {}
+        for code, asym in enumerate(self.asyms):
+            asymLookup[asym] = code
+        minSeq = min(int(seqIds.min()), min(seq for _, seq in structIndex))
+        maxSeq = max(int(seqIds.max()), max(seq for _, seq in structIndex))
+        lookup = np.full((len(self.asyms), maxSeq - minSeq + 1), cifreader.STRUCT_LOOP, dtype=np.int8)
+        for (asym, seq), structType in structIndex.items():
+            if asym in asymLookup:
+                lookup[asymLookup[asym], seq - minSeq] = structType
+
+        types[valid] = lookup[self.asymCodes[valid], seqIds - minSeq]
+        return types
+
+    # One integer key per residue (asym, residue number) for every atom
+    def residueKeys(self):
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        seq = self.seqId.astype(np.int64)
+        seq -= seq.min()
+        return self.asymCodes.astype(np.int64) * (int(seq.max()) + 1) + seq
+
+#################################################################################
+# One row per residue with statistics over its atoms, from aggregateResidues(). It has the
+# columns of an AtomTable so it can be played or exported like one: site, atom name and
+# labels are those of the residue's first atom, bfactor is the mean B factor and coords the
+# centroid. atomCount and maxBfactor are added.
+class ResidueTable(AtomTable):
+    def __init__(self, source, residueOf, atomCount, maxBfactor, **columns):
+        AtomTable.__init__(self, **columns)
+        self.source = source            # AtomTable the residues were aggregated from
+        self.residueOf = residueOf      # Residue row of every atom of source
+        self.atomCount = atomCount      # int32 number of atoms per residue
+        self.maxBfactor = maxBfactor    # float32 highest B factor per residue
+
+    # Mean of a per atom column of the source table over the atoms of each residue
+    def mean(self, values):
+        return np.bincount(self.residueOf, weights=values, minlength=len(self)) / np.maximum(self.atomCount, 1)
+
+#################################################################################
+# Encode a chunk of labels as codes into a growing list of labels
+def encodeLabels(values, labels, lookup):
+    unique, inverse = np.unique(np.asarray(values), return_inverse=True)
+    codes = np.empty(len(unique), dtype=np.uint16)
+    for i, label in enumerate(unique.tolist()):
+        code = lookup.get(label)
+        if code is None:
+            code = lookup[label] = len(labels)
+            if isinstance(label, bytes):
+                # Columns of the memory-mapped reader are bytes
+                label = label.decode("utf-8")
+            # The atom rows are split on white space, so quoted labels (e.g. "C1'") keep their quotes
+            if label[:1] in ("'", '"') and len(label) > 1 and label[-1] == label[0]:
+                label = label[1:-1]
+            labels.append(label)
+        codes[i] = code
+    return codes[inverse.reshape(-1)]
+
+# Convert residue numbers, which are "." for ligands and waters, to int32 (MISSING_SEQ when
+# missing)
+def seqNumbers(values):
+    try:
+        return np.array(values, dtype=np.int32)
+    except ValueError:
+        values = np.asarray(values)
+        missing = np.isin(values, np.array([".", "?"]).astype(values.dtype))
+        numbers = np.full(len(values), MISSING_SEQ, dtype=np.int32)
+        numbers[~missing] = values[~missing].astype(np.int32)
+        return numbers
+
+# Builds an AtomTable from record fields added one row at a time (or a block of rows at a
+# time as columns), converting them to typed column chunks every chunkSize rows. Rows are
+# always converted in the same chunks, so the labels get the same codes either way.
+# With coordinates=False the x/y/z columns are not converted.
+class TableBuilder(object):
+    def __init__(self, coordinates=True):
+        self.coordinates = coordinates
+        self.columns = {}
+        for name in ("site", "entity", "seqId", "bfactor", "coords", "atom", "residue", "asym"):
+            self.columns[name] = []
+        self.labels = {"atom": [], "residue": [], "asym": []}
+        self.lookups = {"atom": {}, "residue": {}, "asym": {}}
+        self.rows = []
+        self.blocks = []        # Pending blocks of columns and their number of rows
+        self.blockRows = 0
+
+    def add(self, entry):
+        self.rows.append(entry)
+        if len(self.rows) >= chunkSize:
+            self.convert()
+
+    # Add a block of rows given as one array per field of cifreader.ATOM_FIELDS (e.g. an
+    # mmapreader.Block). The coordinate columns may be None when they are not converted.
+    def addColumns(self, fields):
+        if len(fields[cifreader.SITE]) == 0:
+            return
+        if self.rows:
+            self.convert()
+        self.blocks.append(fields)
+        self.blockRows += len(fields[cifreader.SITE])
+        if self.blockRows >= chunkSize:
+            self.convertBlocks()
+
+    # Turn the pending rows into typed column chunks
+    def convert(self):
+        if self.blocks:
+            self.convertBlocks(True)
+        if not self.rows:
+            return
+        fields = list(zip(*self.rows))
+        self.rows = []
+        self.convertFields(fields)
+
+    # Turn the pending blocks into column chunks of chunkSize rows. The remaining rows are
+    # kept for the next block unless last is True.
+    def convertBlocks(self, last=False):
+        fields = []
+        for field in zip(*self.blocks):
+            fields.append(None if field[0] is None else np.concatenate(field))
+        self.blocks = []
+        self.blockRows = 0
+        count = len(fields[cifreader.SITE])
+        for start in range(0, count, chunkSize):
+            stop = min(start + chunkSize, count)
+            chunk = [None if field is None else field[start:stop] for field in fields]
+            if stop - start < chunkSize and not last:
+                self.blocks.append(chunk)
+                self.blockRows = stop - start
+            else:
+                self.convertFields(chunk)
+
+    def convertFields(self, fields):
+        with profiling.stage("convert columns"):
+            columns = self.columns
+            columns["site"].append(np.array(fields[cifreader.SITE], dtype=np.int32))
+            columns["entity"].append(np.array(fields[cifreader.ENTITY], dtype=np.int32))
+            columns["seqId"].append(seqNumbers(fields[cifreader.SEQ]))
+            columns["bfactor"].append(np.array(fields[cifreader.BFACTOR], dtype=np.float32))
+            if self.coordinates:
+                columns["coords"].append(np.array(fields[cifreader.X:cifreader.Z+1], dtype=np.float32).T)
+            for name, field in (("atom", cifreader.ATOM_NAME), ("residue", cifreader.COMP),
+                    ("asym", cifreader.ASYM)):
+                columns[name].append(encodeLabels(fields[field], self.labels[name], self.lookups[name]))
+
+    def table(self):
+        self.convert()
+        columns = self.columns
+        return AtomTable(
+                site=joinColumn(columns["site"], np.int32),
+                atomCodes=joinColumn(columns["atom"], np.uint16),
+                atomNames=self.labels["atom"],
+                residueCodes=joinColumn(columns["residue"], np.uint16),
+                residues=self.labels["residue"],
+                asymCodes=joinColumn(columns["asym"], np.uint16),
+                asyms=self.labels["asym"],
+                entity=joinColumn(columns["entity"], np.int32),
+                seqId=joinColumn(columns["seqId"], np.int32),
+                bfactor=joinColumn(columns["bfactor"], np.float32),
+                coords=joinColumn(columns["coords"], np.float32, (0, 3)),
+            )
+
+# Build an AtomTable from cifreader ATOM records, skipping the atoms named in skipAtoms.
+# Other record kinds are passed to onRecord (if given) so the caller can handle them
+# in the same pass. With coordinates=False the x/y/z columns are not converted.
+def buildTable(records, skipAtoms=BACKBONE, onRecord=None, coordinates=True):
+    skip = frozenset(skipAtoms)
+    builder = TableBuilder(coordinates)
+    for record in records:
+        if record.kind != cifreader.ATOM:
+            if onRecord is not None:
+                onRecord(record)
+            continue
+        entry = record.fields
+        if entry[cifreader.ATOM_NAME] in skip:
+            continue
+        builder.add(entry)
+    return builder.table()
+
+def joinColumn(chunks, dtype, emptyShape=(0,)):
+    if not chunks:
+        return np.empty(emptyShape, dtype=dtype)
+    if len(chunks) == 1:
+        return np.ascontiguousarray(chunks[0])
+    return np.concatenate(chunks)
+
+#################################################################################
+# Group the atoms of a table by residue (asym, residue number) in one vectorized pass:
+# sort the atoms by residue, then reduce each run of equal keys. Residues are in file order.
+def aggregateResidues(atoms):
+    keys = atoms.residueKeys()
+    order = np.argsort(keys, kind="stable")
+    sortedKeys = keys[order]
+    boundaries = np.ones(len(keys), dtype=bool)
+    boundaries[1:] = sortedKeys[1:] != sortedKeys[:-1]
+    starts = np.flatnonzero(boundaries)
+
+    # Put the residues in the order of their first atom
+    first = order[starts]
+    fileOrder = np.argsort(first, kind="stable")
+    rank = np.empty(len(starts), dtype=np.int64)
+    rank[fileOrder] = np.arange(len(starts))
+    residueOf = np.empty(len(keys), dtype=np.int64)
+    residueOf[order] = rank[np.cumsum(boundaries) - 1]
+    first = first[fileOrder]
+
+    atomCount = np.diff(np.append(starts, len(keys))).astype(np.int32)[fileOrder]
+    bfactor = atoms.bfactor[order].astype(np.float64)
+    meanBfactor = (np.add.reduceat(bfactor, starts)[fileOrder] / atomCount) if len(starts) else bfactor
+    maxBfactor = np.maximum.reduceat(atoms.bfactor[order], starts)[fileOrder] if len(starts) else atoms.bfactor
+    if atoms.hasCoordinates() and len(starts):
+        centroid = np.add.reduceat(atoms.coords[order].astype(np.float64), starts)[fileOrder] / atomCount[:, None]
+    else:
+        centroid = np.empty((0, 3))
+
+    return ResidueTable(atoms, residueOf, atomCount, maxBfactor.astype(np.float32),
+            site=atoms.site[first],
+            atomCodes=atoms.atomCodes[first],
+            atomNames=atoms.atomNames,
+            residueCodes=atoms.residueCodes[first],
+            residues=atoms.residues,
+            asymCodes=atoms.asymCodes[first],
+            asyms=atoms.asyms,
+            entity=atoms.entity[first],
+            seqId=atoms.seqId[first],
+            bfactor=meanBfactor.astype(np.float32),
+            coords=centroid.astype(np.float32),
+        )
+
+# The same structure with its atom table aggregated by residue
+def residueStructure(structure):
+    with profiling.stage("aggregate residues"):
+        return structure._replace(atoms=aggregateResidues(structure.atoms))
+
+#################################################################################
+# Parse an mmCIF or legacy PDB file (recognised from its content, see pdbreader) into a
+# Structure in a single streaming pass over the categories used (found with the cifindex
+# section index). The helix and sheet ranges go into the secondary structure index and the
+# ATOM records into the table.
+# The coordinates are only extracted when coordinates is True.
+# Options applied while streaming:
+#   model     only read this model of a multi-model file (None reads every model)
+#   ligands   put the HETATM atoms of ligands into a separate table (Structure.hetatms)
+#   waters    put the HETATM atoms of waters into that table as well
+# When neither ligands nor waters are wanted the HETATM rows are skipped unsplit.
+# With mapped=True mmCIF files are read with mmapreader (the result is the same).
+def readStructure(path, skipAtoms=BACKBONE, secondaryStructure=True, coordinates=True,
+        model=None, ligands=False, waters=False, mapped=False):
+    structIndex = {}
+    hetatms = TableBuilder(coordinates)
+    def onRecord(record):
+        if record.kind != cifreader.HETATM:
+            with profiling.stage("secondary structure"):
+                cifreader.addStructRange(structIndex, record)
+        elif (waters if record.fields[cifreader.COMP] in WATERS else ligands):
+            hetatms.add(record.fields)
+
+    kinds = [cifreader.ATOM]
+    if secondaryStructure:
+        kinds.extend((cifreader.HELIX, cifreader.SHEET))
+    if ligands or waters:
+        kinds.append(cifreader.HETATM)
+    legacy = pdbreader.isLegacyPDB(path)
+    if mapped and not legacy:
+        return readMappedStructure(path, kinds, skipAtoms, coordinates, model, ligands, waters)
+    if legacy:
+        records = pdbreader.readRecords(path, kinds, model)
+    else:
+        # Only read the blocks of the categories used, see cifindex
+        with profiling.stage("section index"):
+            sections = cifindex.sectionsOf(cifindex.readIndex(path), cifreader.categoriesFor(kinds))
+        records = cifreader.readSections(path, sections, kinds, model)
+    records = profiling.timedIterator("read records", records)
+    atoms = buildTable(records, skipAtoms, onRecord=onRecord, coordinates=coordinates)
+    return Structure(atoms, structIndex, hetatms.table() if ligands or waters else None)
+
+# readStructure() of an mmCIF file through mmapreader. The atom rows arrive as blocks of
+# columns and are filtered with masks over the whole block.
+def readMappedStructure(path, kinds, skipAtoms, coordinates, model, ligands, waters):
+    skip = np.array(sorted(skipAtoms), dtype=bytes)
+    waterNames = np.array(WATERS, dtype=bytes)
+    structIndex = {}
+    atoms = TableBuilder(coordinates)
+    hetatms = TableBuilder(coordinates)
+    with mmapreader.MappedFile(path) as mapped:
+        with profiling.stage("secondary structure"):
+            for record in mapped.records(kinds):
+                cifreader.addStructRange(structIndex, record)
+
+        blocks = profiling.timedIterator("read records", mapped.atomBlocks(kinds, model, coordinates))
+        for block in blocks:
+            columns = block.columns
+            if block.kind == cifreader.ATOM:
+                keep = ~np.isin(columns[cifreader.ATOM_NAME], skip)
+                builder = atoms
+            else:
+                isWater = np.isin(columns[cifreader.COMP], waterNames)
+                keep = (isWater & waters) | (~isWater & ligands)
+                builder = hetatms
+            if not keep.all():
+                columns = [None if column is None else column[keep] for column in columns]
+            builder.addColumns(columns)
+    return Structure(atoms.table(), structIndex, hetatms.table() if ligands or waters else None)
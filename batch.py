@@ -0,0 +1,123 @@
+"""
+Non-interactive batch mode shared by pdb2json.py and PDB_parser.py.
+
+Expands the files, directories and glob patterns given on the command line and fans the
+per-file work out across a ProcessPoolExecutor, reporting how long each file took and
+which files failed.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import sys
+import time
+import traceback
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# File types picked up when a directory is given
+extensions = (".cif", ".mmcif", ".txt", ".pdb", ".ent")
+
+# Outcome of one file: its result on success or the error message on failure
+Result = namedtuple("Result", ["path", "seconds", "value", "error"])
+
+#################################################################################
+# Expand files, directories (searched recursively) and glob patterns into a sorted list
+# of unique file paths
+def expandPaths(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        paths.append(os.path.join(root, name))
+        elif os.path.isfile(pattern):
+            paths.append(pattern)
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                print("No files match %s" % pattern, file=sys.stderr)
+            paths.extend(path for path in matches if os.path.isfile(path))
+
+    # Keep the first occurrence of each file
+    seen = set()
+    unique = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique
+
+#################################################################################
+# Call function(path, *args) and time it. Runs inside the worker processes, so failures
+# are caught here and sent back as text rather than as exceptions.
+def timedCall(function, path, args):
+    start = time.perf_counter()
+    try:
+        value = function(path, *args)
+        return Result(path, time.perf_counter() - start, value, None)
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        if os.environ.get("WIAC_TRACEBACK"):
+            error = traceback.format_exc()
+        return Result(path, time.perf_counter() - start, None, error)
+
+# Run function(path, *args) on every path with up to `workers` processes (None for one per
+# CPU, 1 to stay in this process). Prints a line per file as it finishes and returns the
+# results in the order of paths.
+def runBatch(function, paths, args=(), workers=None, report=True):
+    results = {}
+    start = time.perf_counter()
+
+    def finished(result):
+        results[result.path] = result
+        if report:
+            if result.error is None:
+                print("ok    %8.3fs  %s" % (result.seconds, result.path))
+            else:
+                print("FAIL  %8.3fs  %s\n      %s" % (result.seconds, result.path, result.error))
+
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            finished(timedCall(function, path, args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(timedCall, function, path, args) for path in paths]
+            for future in as_completed(futures):
+                finished(future.result())
+
+    ordered = [results[path] for path in paths]
+    if report:
+        printSummary(ordered, time.perf_counter() - start)
+    return ordered
+
+def printSummary(results, seconds):
+    failures = [result for result in results if result.error is not None]
+    busy = sum(result.seconds for result in results)
+    print("\n%d file(s), %d failed, %.3fs wall clock, %.3fs total per-file time" % (
+            len(results), len(failures), seconds, busy))
+    for result in failures:
+        print("  failed: %s" % result.path)
+
+#################################################################################
+# Command line options common to the batch entry points
+def addArguments(parser):
+    parser.add_argument("paths", nargs="*",
+            help="mmCIF files, directories or glob patterns (prompts for one file when omitted)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+            help="number of worker processes (default: one per CPU, 1 to disable the pool)")
+
+# Model selection for multi-model files (NMR ensembles), shared by all of the scripts
+def modelNumber(value):
+    if value.lower() == "all":
+        return None
+    return int(value)
+
+def addModelArgument(parser):
+    parser.add_argument("-m", "--model", type=modelNumber, default=1,
+            help="model of multi-model files (e.g. NMR ensembles) to read, or 'all' (default: 1)")
@@ -0,0 +1,275 @@
+"""
+Benchmarks for the parse, export and playback paths, so a change to the parser, pdb2json
+or the OSC loop can be checked for speed regressions.
+
+Synthetic mmCIF files are made by repeating the _atom_site rows of 5nx2.txt (renumbered and
+moved apart) `scale` times, so scale 300 gives about a million atom rows. For each scale:
+    parse     atomtable.readStructure: seconds, atom rows/s, MB/s and the tracemalloc peak,
+              streamed and memory-mapped (mapped=True)
+    export    pdb2json.pushJSON and pushBinary: seconds and output size
+    contacts  contacts.contactColumns: seconds
+On 5nx2.txt the OSC playback is timed against a local UDP sink: ticks are sent on the
+drift-free schedule (scheduler.py) and the jitter of their arrival times and the cost of a
+tick (with and without the packet cache) are measured.
+
+The results are written as JSON so runs can be compared, e.g.
+    python benchmarks.py --scales 1 30 300 -o results.json
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+import atomtable
+import cifindex
+import contacts
+import oscengine
+import pdb2json
+import pdb2osc
+import scheduler
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Structure the synthetic files are made from
+sourceFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "5nx2.txt")
+
+# Distance (Angstroms) between the copies of the structure in a synthetic file
+copyOffset = 200.0
+
+#################################################################################
+# SYNTHETIC FILES ###############################################################
+# Write a copy of source with its _atom_site rows repeated `scale` times. Each copy gets new
+# site numbers and is moved copyOffset along x. Returns the number of atom rows written.
+def syntheticFile(path, scale, source=sourceFile):
+    with open(source, 'r') as file:
+        lines = file.readlines()
+
+    # Column positions of the fields to rewrite
+    headers = [line.split()[0].partition(".")[2] for line in lines if line.startswith("_atom_site.")]
+    siteColumn = headers.index("id")
+    xColumn = headers.index("Cartn_x")
+    rows = [n for n, line in enumerate(lines) if line.startswith(("ATOM ", "HETATM"))]
+    first, last = rows[0], rows[-1]
+    atomRows = [lines[n].split() for n in rows]
+
+    count = 0
+    with open(path, 'w') as file:
+        file.writelines(lines[:first])
+        for copy in range(scale):
+            shift = copy * copyOffset
+            for row in atomRows:
+                count += 1
+                row = list(row)
+                row[siteColumn] = str(count)
+                row[xColumn] = "%.3f" % (float(row[xColumn]) + shift)
+                file.write(" ".join(row) + "\n")
+        file.writelines(lines[last+1:])
+    return count
+
+#################################################################################
+# Best (lowest) time of `repeat` calls of function(*args), and its last result
+def bestTime(function, args=(), repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+# Peak memory (bytes traced by tracemalloc) while calling function(*args)
+def peakMemory(function, args=()):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Parse a file through mmapreader
+def readMapped(path):
+    return atomtable.readStructure(path, mapped=True)
+
+#################################################################################
+# Parse, export and contacts benchmarks of one file
+def benchmarkFile(path, rows, directory, repeat=3, withContacts=True):
+    size = os.path.getsize(path)
+    result = {
+        "file": os.path.basename(path),
+        "bytes": size,
+        "rows": rows,
+    }
+    for name, parse in (("parse", atomtable.readStructure), ("parseMapped", readMapped)):
+        seconds, structure = bestTime(parse, (path,), repeat)
+        result[name] = {
+            "seconds": seconds,
+            "rowsPerSecond": rows / seconds,
+            "megabytesPerSecond": size / seconds / 1e6,
+            "peakBytes": peakMemory(parse, (path,)),
+        }
+    result["atoms"] = len(structure.atoms)
+
+    jsonPath = os.path.join(directory, "bench.json")
+    binaryPath = os.path.join(directory, "bench.bin")
+    jsonSeconds, _ = bestTime(pdb2json.pushJSON, (structure, jsonPath), repeat)
+    binarySeconds, _ = bestTime(pdb2json.pushBinary, (structure, binaryPath), repeat)
+    result["export"] = {
+        "jsonSeconds": jsonSeconds,
+        "jsonBytes": os.path.getsize(jsonPath),
+        "binarySeconds": binarySeconds,
+        "binaryBytes": os.path.getsize(binaryPath),
+    }
+    os.remove(jsonPath)
+    os.remove(binaryPath)
+
+    if withContacts:
+        result["contacts"] = {"seconds": bestTime(contacts.contactColumns, (structure.atoms,), 1)[0]}
+    return result
+
+#################################################################################
+# OSC PLAYBACK ##################################################################
+# Receives datagrams on a local port and records their arrival times
+class UDPSink(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+        self.arrivals = []
+        self.running = True
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        while self.running:
+            try:
+                self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            self.arrivals.append(time.perf_counter())
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+# Play `ticks` ticks of a stream to a UDP sink on a drift-free schedule. Returns the
+# jitter of the arrival intervals and the time spent building and sending each tick.
+def benchmarkPlayback(structure, ticks=500, period=0.005, packetCache=False):
+    stream = oscengine.Stream(structure, pdb2osc.hydroVals, pdb2osc.aaCategories)
+    if packetCache:
+        stream.cachePackets()
+    sink = UDPSink()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ("127.0.0.1", sink.port)
+    schedule = scheduler.Scheduler(period)
+    durations = []
+    try:
+        for _ in range(ticks):
+            deadline = schedule.wait()
+            start = time.perf_counter()
+            sender.sendto(stream.nextDatagram(schedule.timetag(deadline)), address)
+            durations.append(time.perf_counter() - start)
+        time.sleep(0.05)
+    finally:
+        sender.close()
+        sink.close()
+
+    intervals = np.diff(np.array(sink.arrivals)) if len(sink.arrivals) > 1 else np.zeros(1)
+    deviation = np.abs(intervals - period)
+    durations = np.array(durations)
+    return {
+        "packetCache": packetCache,
+        "ticks": ticks,
+        "received": len(sink.arrivals),
+        "period": period,
+        "jitterMeanMs": float(deviation.mean() * 1000),
+        "jitterMaxMs": float(deviation.max() * 1000),
+        "jitterStdMs": float(intervals.std() * 1000),
+        "tickMeanUs": float(durations.mean() * 1e6),
+        "tickMaxUs": float(durations.max() * 1e6),
+        "lateTicks": schedule.lateTicks,
+    }
+
+#################################################################################
+# Versions and machine the results were measured on
+def environment():
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+def printFile(result):
+    parse = result["parse"]
+    export = result["export"]
+    print("%-14s %9d rows %8.1f MB  parse %7.3fs  %10.0f rows/s  %6.1f MB/s  peak %7.1f MB"
+            % (result["file"], result["rows"], result["bytes"] / 1e6, parse["seconds"],
+               parse["rowsPerSecond"], parse["megabytesPerSecond"], parse["peakBytes"] / 1e6))
+    mapped = result["parseMapped"]
+    print("%-14s %27s mmap  %7.3fs  %10.0f rows/s  %6.1f MB/s  peak %7.1f MB" % ("", "",
+            mapped["seconds"], mapped["rowsPerSecond"], mapped["megabytesPerSecond"],
+            mapped["peakBytes"] / 1e6))
+    print("%-14s json %.3fs (%.1f MB)  binary %.3fs (%.1f MB)%s" % ("", export["jsonSeconds"],
+            export["jsonBytes"] / 1e6, export["binarySeconds"], export["binaryBytes"] / 1e6,
+            "  contacts %.3fs" % result["contacts"]["seconds"] if "contacts" in result else ""))
+
+def printPlayback(result):
+    print("osc %-12s %d/%d received  jitter mean %.3f ms  max %.3f ms  tick mean %.1f us  max %.1f us"
+            % ("packet cache" if result["packetCache"] else "encode", result["received"],
+               result["ticks"], result["jitterMeanMs"], result["jitterMaxMs"], result["tickMeanUs"],
+               result["tickMaxUs"]))
+
+#################################################################################
+# Main Loop
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parse, export and playback paths.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 30],
+            help="sizes of the synthetic files as multiples of 5nx2.txt (300 is about a million "
+                 "atom rows; default: %(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+            help="runs per timing, the best one is kept (default: %(default)s)")
+    parser.add_argument("--ticks", type=int, default=500,
+            help="OSC ticks sent per playback benchmark, 0 to skip it (default: %(default)s)")
+    parser.add_argument("--period", type=float, default=0.005,
+            help="seconds per tick in the playback benchmark (default: %(default)s)")
+    parser.add_argument("--no-contacts", action="store_true", help="skip the contacts benchmark")
+    parser.add_argument("-o", "--output", default="benchmark-results.json",
+            help="file the results are written to (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "files": [], "playback": []}
+    with tempfile.TemporaryDirectory(prefix="wiac-bench-") as directory:
+        for scale in args.scales:
+            path = os.path.join(directory, "synthetic-%d.cif" % scale)
+            rows = syntheticFile(path, scale)
+            result = benchmarkFile(path, rows, directory, args.repeat, not args.no_contacts)
+            result["scale"] = scale
+            os.remove(path)
+            cifindex.removeSidecar(path)
+            results["files"].append(result)
+            printFile(result)
+
+    if args.ticks:
+        structure = atomtable.readStructure(sourceFile)
+        for packetCache in (False, True):
+            result = benchmarkPlayback(structure, args.ticks, args.period, packetCache)
+            results["playback"].append(result)
+            printPlayback(result)
+
+    with open(args.output, 'w') as outputfile:
+        json.dump(results, outputfile, indent=2)
+    print("Results written to %s" % args.output)
+
+if __name__ == '__main__': main()
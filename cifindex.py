@@ -0,0 +1,224 @@
+"""
+Section index of mmCIF files: the byte range of every block of every category.
+
+The readers used to walk every line of a file and compare it against the record prefixes
+just to find the few categories they use. With the index they seek straight to the blocks
+they need (_atom_site, _struct_conf, _struct_sheet_range) and skip the rest of the file.
+The secondary structure can be read without the atoms and the atoms without the secondary
+structure, and since the blocks are independent byte ranges they could be read
+concurrently too.
+
+The index is built in one pass that only stops at lines starting with "#", "_", ";",
+"loop_" or "data_" (a single regular expression search over the memory-mapped file), so
+the atom rows are never looked at one by one. For files of at least sidecarBytes the index
+is also saved as a small JSON sidecar under indexDir, keyed on the path and checked
+against the size and modification time of the file, so later reads skip the pass.
+Sidecars of files that no longer exist are removed, and the least recently used ones are
+evicted once the sidecars take more than maxBytes. Their location and size limit can be
+set with the WIAC_INDEX_DIR and WIAC_INDEX_MB environment variables.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import time
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+indexDir = os.environ.get("WIAC_INDEX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "wiac-index"))
+maxBytes = int(float(os.environ.get("WIAC_INDEX_MB", "16")) * 1024 * 1024)
+
+# Smallest file whose index is saved as a sidecar. Smaller files are indexed in a few ms.
+sidecarBytes = 8 << 20
+
+# Version of the sidecar format
+indexVersion = 1
+
+# One block of a category: the offset of its first "_category.field" line, the offset of
+# the end of the block and whether it is a loop_ (then "loop_" is the line before start)
+Section = namedtuple("Section", ["start", "end", "loop"])
+
+# Lines that can start, end or be inside a block without being data rows. The pattern
+# starts with a literal newline so the search can skip ahead quickly (the first line of
+# the file is matched by the "\n" put in front of it in markerLines).
+markerPattern = re.compile(rb"\n([#_;]|loop_|data_)")
+
+#################################################################################
+# Index the categories of an mmCIF file's content (bytes or an mmap).
+# Returns a dict of category name -> list of Sections, in file order.
+def scanSections(data):
+    sections = {}
+    category = None     # Category of the open block
+    start = 0           # First header line of the open block
+    loop = False        # Whether the open block is a loop_
+    loopPending = False # A "loop_" line was seen and its first header is next
+    inText = False      # Inside a ";" delimited text field
+
+    for marker, lineStart in markerLines(data):
+        if inText:
+            inText = marker != b";"
+            continue
+        if marker == b";":
+            inText = True
+            continue
+        if marker == b"_":
+            lineEnd = data.find(b"\n", lineStart)
+            tag = data[lineStart:lineEnd if lineEnd >= 0 else len(data)].split(None, 1)[0]
+            tagCategory = tag.partition(b".")[0].decode("ascii", "replace")
+            if tagCategory == category:
+                continue
+            if category is not None:
+                sections.setdefault(category, []).append(Section(start, lineStart, loop))
+            category, start, loop = tagCategory, lineStart, loopPending
+            loopPending = False
+            continue
+
+        # "#", "loop_" or "data_" closes the open block
+        if category is not None:
+            sections.setdefault(category, []).append(Section(start, lineStart, loop))
+            category = None
+        loopPending = marker == b"loop_"
+
+    if category is not None:
+        sections.setdefault(category, []).append(Section(start, len(data), loop))
+    return sections
+
+# Marker and offset of every line of data matching markerPattern, the first line included
+def markerLines(data):
+    first = markerPattern.match(b"\n" + data[:5])
+    if first is not None:
+        yield first.group(1), 0
+    for match in markerPattern.finditer(data):
+        yield match.group(1), match.start(1)
+
+#################################################################################
+# Path of the sidecar of a file
+def sidecarPath(path):
+    key = hashlib.sha256(os.path.realpath(path).encode("utf-8")).hexdigest()
+    return os.path.join(indexDir, key + ".json")
+
+# Load the sidecar of a file. Returns None when there is none or the file has changed.
+def loadSidecar(path, stat):
+    sidecar = sidecarPath(path)
+    try:
+        with open(sidecar, 'r') as file:
+            saved = json.load(file)
+        if saved["version"] != indexVersion or saved["size"] != stat.st_size or \
+                saved["mtime"] != stat.st_mtime_ns:
+            return None
+        sections = {}
+        for category, blocks in saved["sections"].items():
+            sections[category] = [Section(*block) for block in blocks]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # Mark the sidecar as recently used
+    try:
+        os.utime(sidecar)
+    except OSError:
+        pass
+    return sections
+
+# Save the sidecar of a file, written to a temporary file and renamed into place. Sidecars
+# are only written for large files, so evicting after each one costs little.
+def storeSidecar(path, stat, sections):
+    saved = {
+        "version": indexVersion,
+        "path": os.path.realpath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sections": sections,
+    }
+    try:
+        os.makedirs(indexDir, exist_ok=True)
+        handle, temp = tempfile.mkstemp(prefix=".tmp-", dir=indexDir)
+        with os.fdopen(handle, 'w') as file:
+            json.dump(saved, file)
+        os.replace(temp, sidecarPath(path))
+    except OSError:
+        # The index is only an optimization
+        return
+    evict()
+
+# Remove the sidecar of a file, e.g. before deleting a temporary file
+def removeSidecar(path):
+    try:
+        os.remove(sidecarPath(path))
+    except OSError:
+        pass
+
+# Remove the sidecars of files that no longer exist, then the least recently used ones
+# until the sidecars fit in limit bytes
+def evict(limit=None):
+    if limit is None:
+        limit = maxBytes
+    sidecars = []
+    total = 0
+    try:
+        names = os.listdir(indexDir)
+    except OSError:
+        return
+    for name in names:
+        sidecar = os.path.join(indexDir, name)
+        try:
+            if name.startswith(".tmp-"):
+                # Leftovers of an interrupted store
+                if time.time() - os.path.getmtime(sidecar) > 3600:
+                    os.remove(sidecar)
+                continue
+            stat = os.stat(sidecar)
+            with open(sidecar, 'r') as file:
+                source = json.load(file).get("path")
+            if source is not None and not os.path.exists(source):
+                os.remove(sidecar)
+                continue
+        except (OSError, ValueError, AttributeError):
+            continue
+        sidecars.append((stat.st_mtime, stat.st_size, sidecar))
+        total += stat.st_size
+
+    sidecars.sort()
+    for used, size, sidecar in sidecars:
+        if total <= limit:
+            break
+        try:
+            os.remove(sidecar)
+        except OSError:
+            pass
+        total -= size
+
+#################################################################################
+# Section index of an mmCIF file, from its sidecar when it is up to date. data may be the
+# file's content already mapped (e.g. by mmapreader) to save mapping it again.
+def readIndex(path, data=None):
+    stat = os.stat(path)
+    useSidecar = stat.st_size >= sidecarBytes
+    if useSidecar:
+        sections = loadSidecar(path, stat)
+        if sections is not None:
+            return sections
+
+    if data is not None:
+        sections = scanSections(data)
+    elif stat.st_size == 0:
+        sections = {}
+    else:
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sections = scanSections(mapped)
+
+    if useSidecar:
+        storeSidecar(path, stat, sections)
+    return sections
+
+# The sections of the given categories, in file order
+def sectionsOf(sections, categories):
+    found = []
+    for category in categories:
+        found.extend(sections.get(category, ()))
+    return sorted(found)
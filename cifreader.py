@@ -0,0 +1,338 @@
+"""
+Shared streaming reader for plain text mmCIF files. Used by PDB_parser.py, pdb2json.py
+and pdb2osc.py so the three scripts no longer load the whole file with readlines().
+
+Lines are read lazily and dispatched on their record prefix before any splitting is done,
+so the header blocks (and any category we don't care about) are skipped without being
+tokenized. Only ATOM, HETATM, HELX_P and _struct_sheet_range rows are yielded.
+
+A single model of a multi-model file (e.g. an NMR ensemble) can be selected with the model
+argument. Rows of the other models are recognised from their pdbx_PDB_model_num column
+without being split into fields, so they cost next to nothing.
+
+Column positions are not hard-coded. The _atom_site.*, _struct_conf.* and
+_struct_sheet_range.* headers of each loop_ are read once and compiled into an itemgetter,
+so every record comes out with its fields in the fixed order given by ATOM_FIELDS,
+HELIX_FIELDS and SHEET_FIELDS no matter how the deposition orders its columns.
+
+readSections() only reads the blocks of the categories it is given (see cifindex) and
+seeks over the rest of the file.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+from operator import itemgetter
+import codecs
+import re
+
+#################################################################################
+# RECORD TYPES ##################################################################
+ATOM = "ATOM"
+HETATM = "HETATM"
+HELIX = "HELX_P"
+SHEET = "_struct_sheet_range"
+
+ALL_KINDS = (ATOM, HETATM, HELIX, SHEET)
+
+# A single parsed row: the record kind and a tuple of the wanted fields
+Record = namedtuple("Record", ["kind", "fields"])
+
+#################################################################################
+# FIELDS ########################################################################
+# Fields pulled from every _atom_site row, in the order they appear in Record.fields
+ATOM_FIELDS = (
+        "id",               # Site number
+        "label_atom_id",    # Atom name
+        "label_comp_id",    # Amino acid label
+        "label_asym_id",    # Asym chain letter
+        "label_entity_id",  # Entity number
+        "label_seq_id",     # Residue (chain) number
+        "B_iso_or_equiv",   # Temperature (B Factor)
+        "Cartn_x",          # Coordinates
+        "Cartn_y",
+        "Cartn_z",
+    )
+SITE, ATOM_NAME, COMP, ASYM, ENTITY, SEQ, BFACTOR, X, Y, Z = range(len(ATOM_FIELDS))
+
+# Fields pulled from _struct_conf (helix) and _struct_sheet_range rows
+RANGE_FIELDS = (
+        "beg_label_asym_id",    # Asym letter at the start of the range
+        "beg_label_seq_id",     # First residue number
+        "end_label_asym_id",    # Asym letter at the end of the range
+        "end_label_seq_id",     # Last residue number
+    )
+HELIX_FIELDS = RANGE_FIELDS
+SHEET_FIELDS = RANGE_FIELDS
+BEGIN_ASYM, BEGIN_SEQ, END_ASYM, END_SEQ = range(len(RANGE_FIELDS))
+
+# mmCIF category for each record kind and the fields wanted from it
+categoryFields = {
+        "_atom_site": ATOM_FIELDS,
+        "_struct_conf": HELIX_FIELDS,
+        "_struct_sheet_range": SHEET_FIELDS,
+    }
+categoryKinds = {
+        "_atom_site": (ATOM, HETATM),
+        "_struct_conf": (HELIX,),
+        "_struct_sheet_range": (SHEET,),
+    }
+
+# The categories holding the records of the given kinds
+def categoriesFor(kinds):
+    return [category for category, categoryKind in categoryKinds.items()
+            if any(kind in kinds for kind in categoryKind)]
+
+# Bytes read at a time by readSections()
+readBytes = 1 << 20
+
+# Field of _struct_conf telling helices (HELX_P, HELX_LH_PP_P, ...) from turns
+CONF_TYPE_FIELD = "conf_type_id"
+
+# Field holding the model number of an _atom_site row
+MODEL_FIELD = "pdbx_PDB_model_num"
+
+# Tokenizer for the (rare) rows outside of _atom_site that may hold quoted values.
+# In mmCIF a quote only closes a value when it is followed by white space.
+tokenPattern = re.compile(r"'(?:[^']|'(?=\S))*'|\"(?:[^\"]|\"(?=\S))*\"|\S+")
+
+#################################################################################
+# Build an itemgetter that pulls the wanted fields out of a split row
+def compileFields(category, headers, wanted):
+    columns = {}
+    for i, name in enumerate(headers):
+        columns[name] = i
+
+    missing = [name for name in wanted if name not in columns]
+    if missing:
+        raise ValueError("%s is missing the field(s): %s" % (category, ", ".join(missing)))
+
+    getter = itemgetter(*[columns[name] for name in wanted])
+    # itemgetter returns a bare value rather than a tuple for a single index
+    if len(wanted) == 1:
+        return lambda row: (getter(row),)
+    return getter
+
+# Split a row that may contain quoted values and strip the quotes
+def splitQuoted(line):
+    values = []
+    for token in tokenPattern.findall(line):
+        if token[0] in "'\"" and len(token) > 1 and token[-1] == token[0]:
+            token = token[1:-1]
+        values.append(token)
+    return values
+
+#################################################################################
+# Stream the records of an mmCIF file. With model set (e.g. 1) only the ATOM and HETATM
+# rows of that model are yielded; files without model numbers hold model 1 only.
+def readRecords(path, kinds=ALL_KINDS, model=None):
+    with open(path, 'r') as file:
+        yield from readLines(file, kinds, model)
+
+# Stream the records of the given sections of an mmCIF file only (byte ranges of category
+# blocks from cifindex), seeking over the rest of the file
+def readSections(path, sections, kinds=ALL_KINDS, model=None):
+    with open(path, 'rb') as file:
+        yield from readLines(sectionLines(file, sections), kinds, model)
+
+# The lines of each section of an open (binary) file, each closed with a "#" line. The
+# bytes are read and decoded readBytes at a time.
+def sectionLines(file, sections):
+    for section in sections:
+        if section.loop:
+            yield "loop_\n"
+        file.seek(section.start)
+        remaining = section.end - section.start
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        tail = ""
+        while remaining > 0:
+            block = file.read(min(remaining, readBytes))
+            if not block:
+                break
+            remaining -= len(block)
+            lines = (tail + decoder.decode(block, remaining <= 0)).split("\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if tail:
+            yield tail + "\n"
+        yield "#\n"
+
+# Stream the records of any iterable of mmCIF lines (a file, or the lines of a few
+# categories cut out of one, see readSections and mmapreader)
+def readLines(lines, kinds=ALL_KINDS, model=None):
+    wantAtoms = ATOM in kinds
+    wantHetatms = HETATM in kinds
+    if model is not None:
+        model = str(model)
+
+    # Only compile mappings for the categories that can produce a wanted record
+    wantedCategories = {}
+    for category, categoryKind in categoryKinds.items():
+        if any(kind in kinds for kind in categoryKind):
+            wantedCategories[category] = categoryFields[category]
+
+    # Loop state
+    inText = False          # Inside a ";" delimited text field
+    inHeader = False        # Reading the "_category.field" headers of a loop_
+    category = None         # Category of the current loop_
+    headers = []            # Field names of the current loop_
+    getter = None           # Compiled itemgetter when the current loop_ is wanted
+    isAtoms = False         # True when the current loop_ is _atom_site
+    groupColumn = 0         # Column of group_PDB when it isn't first (-1 when missing)
+    modelSplit = None       # rsplit count that puts the model number at index 1 (None: no filter)
+    typeColumn = None       # Column of conf_type_id in a _struct_conf loop
+    pending = []            # Tokens of a non-atom row that spans several lines
+    singleRow = {}          # Values of a wanted category written without loop_
+
+    for line in lines:
+        # Hot path: rows of the _atom_site loop
+        if isAtoms:
+            if line.startswith("ATOM "):
+                if wantAtoms and (modelSplit is None or line.rsplit(None, modelSplit)[1] == model):
+                    yield Record(ATOM, getter(line.split()))
+                continue
+            if line.startswith("HETATM"):
+                if wantHetatms and (modelSplit is None or line.rsplit(None, modelSplit)[1] == model):
+                    yield Record(HETATM, getter(line.split()))
+                continue
+            # Rows where group_PDB is not the first column can't be dispatched on prefix
+            if groupColumn and not line.startswith(("#", "_", "loop_", "data_")) and not line.isspace():
+                row = line.split()
+                kind = HETATM if groupColumn > 0 and row[groupColumn] == "HETATM" else ATOM
+                if kind in kinds and (modelSplit is None or row[-modelSplit] == model):
+                    yield Record(kind, getter(row))
+                continue
+
+        if inText:
+            # A line starting with ";" closes the text field
+            if line.startswith(";"):
+                inText = False
+            continue
+
+        if line.startswith("#") or line.startswith("loop_") or line.startswith("data_"):
+            # Flush a category written as single "_category.field value" pairs
+            if singleRow:
+                record = singleRecord(singleRow, model)
+                if record is not None and record.kind in kinds:
+                    yield record
+                singleRow = {}
+            inHeader = line.startswith("loop_")
+            category = None
+            headers = []
+            getter = None
+            isAtoms = False
+            pending = []
+            continue
+
+        if line.startswith("_"):
+            tag = line.split(None, 1)
+            tagCategory, _, field = tag[0].partition(".")
+            if inHeader:
+                category = tagCategory
+                headers.append(field)
+            elif tagCategory in wantedCategories:
+                singleRow.setdefault(tagCategory, {})[field] = tag[1].strip() if len(tag) > 1 else "?"
+            continue
+
+        if line.startswith(";"):
+            # Text fields inside a wanted loop count as a single value
+            inText = True
+            if getter is not None:
+                pending.append("?")
+            continue
+
+        if inHeader:
+            # First data row of the loop: compile the column mapping once
+            inHeader = False
+            if category in wantedCategories:
+                getter = compileFields(category, headers, wantedCategories[category])
+                isAtoms = category == "_atom_site"
+                if category == "_struct_conf":
+                    if CONF_TYPE_FIELD not in headers:
+                        raise ValueError("_struct_conf is missing the field(s): %s" % CONF_TYPE_FIELD)
+                    typeColumn = headers.index(CONF_TYPE_FIELD)
+                if isAtoms:
+                    groupColumn = headers.index("group_PDB") if "group_PDB" in headers else -1
+                    modelSplit = None
+                    if model is not None and MODEL_FIELD in headers:
+                        modelSplit = len(headers) - headers.index(MODEL_FIELD)
+                    elif model is not None and model != "1":
+                        # No model numbers: the only model is 1, skip the whole loop
+                        getter = None
+                        isAtoms = False
+                        continue
+                    # Re-dispatch this row through the hot path
+                    row = line.split()
+                    kind = ATOM
+                    if groupColumn >= 0 and row[groupColumn] == "HETATM":
+                        kind = HETATM
+                    if kind in kinds and (modelSplit is None or row[-modelSplit] == model):
+                        yield Record(kind, getter(row))
+                    continue
+
+        if getter is None or isAtoms or line.isspace():
+            continue
+
+        # Helix and sheet rows. A row may be wrapped over several lines.
+        pending.extend(splitQuoted(line))
+        if len(pending) < len(headers):
+            continue
+        row = pending
+        pending = []
+
+        if category == "_struct_conf":
+            # _struct_conf also lists turns, only keep the helices
+            if row[typeColumn].startswith("HELX") and HELIX in kinds:
+                yield Record(HELIX, getter(row))
+        elif SHEET in kinds:
+            yield Record(SHEET, getter(row))
+
+    # The file may end without a closing "#"
+    if singleRow:
+        record = singleRecord(singleRow, model)
+        if record is not None and record.kind in kinds:
+            yield record
+
+# Turn a category written without loop_ into a record (None when it isn't wanted)
+def singleRecord(singleRow, model=None):
+    for category, values in singleRow.items():
+        headers = list(values)
+        row = [(splitQuoted(values[name]) or ["?"])[0] for name in headers]
+        getter = compileFields(category, headers, categoryFields[category])
+        if category == "_atom_site":
+            if model is not None and values.get(MODEL_FIELD, "1") != model:
+                return None
+            return Record(HETATM if values.get("group_PDB") == "HETATM" else ATOM, getter(row))
+        if category == "_struct_conf":
+            if values.get(CONF_TYPE_FIELD, "").startswith("HELX"):
+                return Record(HELIX, getter(row))
+            return None
+        return Record(SHEET, getter(row))
+    return None
+
+#################################################################################
+# SECONDARY STRUCTURE INDEX #####################################################
+# Structure types (same values as the structType entries sent to Unity and Pd)
+STRUCT_HELIX = 0
+STRUCT_SHEET = 1
+STRUCT_LOOP = 2
+
+# Add the residues of a HELX_P or sheet range record to a secondary structure index.
+# The index is a dict keyed on (asym, seq_id) so every residue lookup is constant time.
+# Helices take priority over sheets whatever order the records arrive in.
+def addStructRange(structIndex, record):
+    entry = record.fields
+    asym = entry[BEGIN_ASYM]
+    first = int(entry[BEGIN_SEQ])
+    last = int(entry[END_SEQ])
+
+    if record.kind == HELIX:
+        for seq in range(first, last+1):
+            structIndex[(asym, seq)] = STRUCT_HELIX
+    else:
+        for seq in range(first, last+1):
+            structIndex.setdefault((asym, seq), STRUCT_SHEET)
+
+# Get the structure type (helix, sheet or loop) of a single residue
+def structType(structIndex, asym, seq):
+    return structIndex.get((asym, seq), STRUCT_LOOP)
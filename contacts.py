@@ -0,0 +1,208 @@
+"""
+Contact-driven parameters from the atom coordinates: local packing density and residue
+contacts.
+
+Neighbours are found with a uniform grid built once per structure. Every atom is put in a
+cubic cell as large as the search radius, so all its neighbours are in the 27 cells around
+it. The atoms are sorted by cell so the atoms of a cell are one contiguous range, and the
+ranges of each cell's neighbour cells are looked up once when the index is built. Queries
+run in batches of atoms with NumPy, never as a pairwise loop over all atoms, so large
+complexes take roughly linear time.
+
+    density   number of other atoms within densityRadius of an atom
+    contacts  number of other residues with an atom within contactRadius of any atom of
+              the atom's residue (the same for every atom of a residue)
+
+ligandContacts() finds the ligand bound to each residue: the HETATM residue (waters
+excepted) with an atom within contactRadius of an atom of the residue, the closest one when
+there are several. oscengine sends it as a /ligand event for drug-binding pieces.
+
+NOTE: the counts only include the atoms in the table, i.e. the R Group atoms when the
+backbone is skipped.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+import itertools
+import numpy as np
+import atomtable
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Default radii in Angstroms
+densityRadius = 8.0
+contactRadius = 4.5
+
+# Number of query atoms per batch. Bounds the memory used for candidate pairs.
+chunkSize = 32768
+
+# Per atom contact parameters
+Contacts = namedtuple("Contacts", ["density", "contacts"])
+
+#################################################################################
+class GridIndex(object):
+    def __init__(self, coords, cellSize):
+        coords = np.asarray(coords, dtype=np.float32)
+        self.cellSize = float(cellSize)
+        count = len(coords)
+
+        # Cell of every atom, padded by one cell on each side so the neighbour cells of
+        # every atom have valid keys
+        if count:
+            cells = np.floor((coords - coords.min(axis=0)) / self.cellSize).astype(np.int64) + 1
+            shape = cells.max(axis=0) + 2
+        else:
+            cells = np.zeros((0, 3), dtype=np.int64)
+            shape = np.ones(3, dtype=np.int64)
+        strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+        keys = cells @ strides
+
+        # Atoms sorted by cell, so the atoms of a cell are one contiguous range
+        self.order = np.argsort(keys, kind="stable")
+        self.coords = np.ascontiguousarray(coords[self.order])
+        cellKeys, cellStart = np.unique(keys[self.order], return_index=True)
+        cellEnd = np.append(cellStart[1:], count)
+        self.cellEnd = cellEnd
+        self.atomCell = np.repeat(np.arange(len(cellKeys)), cellEnd - cellStart)
+
+        # Atom range of the neighbour cells of every cell. Each pair of cells is only
+        # looked at once, from the cell with the smaller key: 13 of the 26 neighbour cells.
+        self.neighbours = []
+        for step in itertools.product((-1, 0, 1), repeat=3):
+            offset = int(np.dot(step, strides))
+            if offset <= 0:
+                continue
+            position = np.searchsorted(cellKeys, cellKeys + offset)
+            position = np.minimum(position, len(cellKeys) - 1)
+            found = cellKeys[position] == cellKeys + offset if len(cellKeys) else np.zeros(0, dtype=bool)
+            self.neighbours.append((np.where(found, cellStart[position], 0),
+                    np.where(found, cellEnd[position], 0)))
+
+    def __len__(self):
+        return len(self.coords)
+
+    # All pairs of different atoms within radius of each other, in batches of atoms.
+    # Yields (i, j) arrays of atom indices. Every pair is yielded once, in one order.
+    def pairs(self, radius):
+        if radius > self.cellSize:
+            raise ValueError("radius %g is larger than the cell size %g" % (radius, self.cellSize))
+        limit = radius * radius
+        for start in range(0, len(self), chunkSize):
+            stop = min(start + chunkSize, len(self))
+            queries = np.arange(start, stop)
+            cells = self.atomCell[start:stop]
+
+            # The later atoms of the same cell, then the atoms of the neighbour cells
+            ranges = [(queries + 1, self.cellEnd[cells])]
+            for cellLow, cellHigh in self.neighbours:
+                ranges.append((cellLow[cells], cellHigh[cells]))
+
+            found = ([], [])
+            for low, high in ranges:
+                counts = high - low
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # Expand each atom into one candidate per atom of the range
+                i = np.repeat(queries, counts)
+                j = np.arange(total) + np.repeat(low - (np.cumsum(counts) - counts), counts)
+                delta = self.coords[i] - self.coords[j]
+                keep = np.einsum("ij,ij->i", delta, delta) <= limit
+                found[0].append(i[keep])
+                found[1].append(j[keep])
+            if found[0]:
+                yield self.order[np.concatenate(found[0])], self.order[np.concatenate(found[1])]
+
+    # Number of other atoms within radius of every atom
+    def countNeighbours(self, radius):
+        counts = np.zeros(len(self), dtype=np.int64)
+        for i, j in self.pairs(radius):
+            counts += np.bincount(i, minlength=len(self))
+            counts += np.bincount(j, minlength=len(self))
+        return counts.astype(np.int32)
+
+#################################################################################
+# Residue of every atom as a code, grouping atoms by (asym, residue number).
+# Returns the codes and the number of residues.
+def residueCodes(atoms):
+    unique, codes = np.unique(atoms.residueKeys(), return_inverse=True)
+    return codes.reshape(-1), len(unique)
+
+# Number of other residues in contact with the residue of every atom
+def residueContacts(atoms, radius=contactRadius, index=None):
+    if index is None:
+        index = GridIndex(atoms.coords, radius)
+    residues, count = residueCodes(atoms)
+
+    # Distinct (residue, other residue) pairs in contact
+    found = []
+    for i, j in index.pairs(radius):
+        first, second = residues[i], residues[j]
+        different = first != second
+        first, second = first[different], second[different]
+        found.append(np.unique(np.concatenate([first * count + second, second * count + first])))
+    if not found:
+        return np.zeros(len(atoms), dtype=np.int32)
+    residuePairs = np.unique(np.concatenate(found))
+
+    perResidue = np.bincount(residuePairs // count, minlength=count).astype(np.int32)
+    return perResidue[residues]
+
+#################################################################################
+# Packing density and residue contacts of every atom of an AtomTable, from one grid index.
+# The table must have been parsed with coordinates. For an atomtable.ResidueTable they are
+# computed from its atoms and averaged over each residue.
+def contactColumns(atoms, density=densityRadius, contact=contactRadius):
+    if isinstance(atoms, atomtable.ResidueTable):
+        perAtom = contactColumns(atoms.source, density, contact)
+        return Contacts(*[np.rint(atoms.mean(column)).astype(np.int32) for column in perAtom])
+    if not atoms.hasCoordinates():
+        raise ValueError("the structure was parsed without coordinates")
+    index = GridIndex(atoms.coords, max(density, contact))
+    return Contacts(index.countNeighbours(density), residueContacts(atoms, contact, index))
+
+#################################################################################
+# Ligand bound to the residue of every atom of an AtomTable: the code (into
+# hetatms.residues) of the residue of the closest ligand atom within radius of any atom of
+# the residue, or -1. Water molecules are not ligands. Both tables must have been parsed
+# with coordinates. For an atomtable.ResidueTable it is computed from its atoms.
+def ligandContacts(atoms, hetatms, radius=contactRadius):
+    if isinstance(atoms, atomtable.ResidueTable):
+        perAtom = ligandContacts(atoms.source, hetatms, radius)
+        bound = np.full(len(atoms), -1, dtype=np.int32)
+        # Every atom of a residue has the same value
+        bound[atoms.residueOf] = perAtom
+        return bound
+    if not atoms.hasCoordinates() or not hetatms.hasCoordinates():
+        raise ValueError("the structure was parsed without coordinates")
+
+    # The ligand atoms go after the atoms of the table in one grid index
+    isWater = np.isin(np.array(hetatms.residues, dtype=object)[hetatms.residueCodes],
+            atomtable.WATERS)
+    ligandCodes = hetatms.residueCodes[~isWater].astype(np.int32)
+    count = len(atoms)
+    coords = np.concatenate([atoms.coords, hetatms.coords[~isWater]])
+    index = GridIndex(coords, radius)
+    residues, residueCount = residueCodes(atoms)
+
+    # Every (residue, distance, ligand) contact between a table atom and a ligand atom
+    found = ([], [], [])
+    for i, j in index.pairs(radius):
+        cross = (i < count) != (j < count)
+        atom = np.where(i < count, i, j)[cross]
+        ligand = np.where(i < count, j, i)[cross]
+        delta = coords[atom] - coords[ligand]
+        found[0].append(residues[atom])
+        found[1].append(np.einsum("ij,ij->i", delta, delta))
+        found[2].append(ligandCodes[ligand - count])
+
+    bound = np.full(residueCount, -1, dtype=np.int32)
+    if found[0]:
+        residue, distance, ligand = [np.concatenate(column) for column in found]
+        # The closest contact of each residue comes first
+        order = np.lexsort((distance, residue))
+        residue, ligand = residue[order], ligand[order]
+        first = np.ones(len(residue), dtype=bool)
+        first[1:] = residue[1:] != residue[:-1]
+        bound[residue[first]] = ligand[first]
+    return bound[residues]
@@ -0,0 +1,198 @@
+"""
+Memory-mapped reader for large mmCIF files.
+
+cifreader turns every line of the file into a str and every atom row into a list of str
+before anything is converted, so the parse allocates several times the size of the
+_atom_site loop. Here the file is mmap'ed instead. The loop is located with the section
+index (cifindex) and its rows are scanned in blocks of about blockBytes: the line and
+token boundaries of a whole block are found at once with NumPy on a zero-copy view of the
+mapped bytes. Only the wanted columns are gathered into fixed-width byte arrays, which
+atomtable.TableBuilder converts to numbers (or to label codes, decoding each distinct
+label once). Nothing is decoded per row, so besides the output arrays the parse only needs
+the work arrays of one block, whatever the size of the file.
+
+The other categories used (the helix and sheet ranges) are small. Their lines are cut out
+of the mapped file and read by cifreader.readLines().
+
+As in cifreader, every atom row must be a single line. A row holding a quoted value with
+white space in it (never seen in _atom_site) is reported as a ValueError.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from collections import namedtuple
+import mmap
+import os
+import numpy as np
+import cifindex
+import cifreader
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Bytes of the _atom_site loop scanned at a time. Bounds the memory of the work arrays.
+blockBytes = 1 << 20
+
+# A block of atom rows of one kind: one fixed-width bytes array per field of
+# cifreader.ATOM_FIELDS (None for the coordinates when they are not wanted)
+Block = namedtuple("Block", ["kind", "columns"])
+
+#################################################################################
+class MappedFile(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped
+            self.data = b""
+        self.sections = cifindex.readIndex(path, self.data)  # Category -> cifindex.Sections
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # A block is still referenced (e.g. after an error), the map is released
+                # with it
+                pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Byte offset of the start of the line after the one at position
+    def nextLine(self, position):
+        end = self.data.find(b"\n", position)
+        return len(self.data) if end < 0 else end + 1
+
+    # Decoded lines of the sections of a category, each with its "loop_" line and closed
+    # with a "#" line, for cifreader.readLines()
+    def categoryLines(self, category):
+        for section in self.sections.get(category, ()):
+            yield from self.sectionLines(section)
+
+    def sectionLines(self, section):
+        if section.loop:
+            yield "loop_\n"
+        for line in self.data[section.start:section.end].decode("utf-8").splitlines(True):
+            yield line
+        yield "#\n"
+
+    # Secondary structure (or other non-atom) records, see cifreader.readLines()
+    def records(self, kinds):
+        for category in cifreader.categoriesFor(kinds):
+            if category != "_atom_site":
+                for record in cifreader.readLines(self.categoryLines(category), kinds):
+                    yield record
+
+    # Field names of the _atom_site loop whose first header line is at start, and the
+    # offset of its first row
+    def loopHeaders(self, start):
+        headers = []
+        position = start
+        while position < len(self.data):
+            end = self.nextLine(position)
+            line = self.data[position:end]
+            if not line.startswith(b"_atom_site."):
+                break
+            headers.append(line.split()[0].partition(b".")[2].decode("ascii"))
+            position = end
+        return headers, position
+
+    # Blocks of the ATOM (and/or HETATM) rows of the _atom_site loops. With model set only
+    # the rows of that model are returned; files without model numbers hold model 1 only.
+    def atomBlocks(self, kinds=(cifreader.ATOM,), model=None, coordinates=True):
+        if model is not None:
+            model = str(model)
+        for section in self.sections.get("_atom_site", ()):
+            if not section.loop:
+                # A single atom written without loop_
+                for record in cifreader.readLines(self.sectionLines(section), kinds, model):
+                    yield Block(record.kind, [np.array([value.encode("utf-8")]) for value in record.fields])
+                continue
+
+            headers, position = self.loopHeaders(section.start)
+            columns = [headers.index(name) if name in headers else None for name in cifreader.ATOM_FIELDS]
+            missing = [name for name, column in zip(cifreader.ATOM_FIELDS, columns) if column is None]
+            if missing:
+                raise ValueError("_atom_site is missing the field(s): %s" % ", ".join(missing))
+            if not coordinates:
+                columns[cifreader.X:cifreader.Z+1] = [None, None, None]
+            groupColumn = headers.index("group_PDB") if "group_PDB" in headers else None
+            modelColumn = None
+            if model is not None and cifreader.MODEL_FIELD in headers:
+                modelColumn = headers.index(cifreader.MODEL_FIELD)
+            if model is not None and modelColumn is None and model != "1":
+                # No model numbers: the only model is 1
+                continue
+
+            # Scan the rows a block at a time
+            while position < section.end:
+                stop = section.end
+                if stop - position > blockBytes:
+                    stop = self.data.rfind(b"\n", position, position + blockBytes) + 1 or stop
+                data = np.frombuffer(self.data, dtype=np.uint8, count=stop - position, offset=position)
+                for block in self.readBlock(data, position, len(headers), columns, groupColumn,
+                        modelColumn, model, kinds):
+                    yield block
+                position = stop
+
+    # Tokenize the rows of a block (data, starting at the file offset offset) and gather the
+    # wanted columns
+    def readBlock(self, data, offset, columnCount, columns, groupColumn, modelColumn, model, kinds):
+        solid = np.zeros(len(data) + 2, dtype=bool)
+        solid[1:-1] = data > 32
+        edges = np.flatnonzero(solid[1:] != solid[:-1])
+        del solid
+        tokenStarts = edges[0::2]
+        tokenEnds = edges[1::2]
+        del edges
+
+        # Every non blank line must be one row: the first and last tokens of a row on the
+        # same line, every row on a later line than the previous one
+        if len(tokenStarts) % columnCount:
+            raise ValueError("_atom_site rows after byte %d don't have %d fields each" % (offset, columnCount))
+        lineBreaks = np.flatnonzero(data == 10)
+        firstLine = np.searchsorted(lineBreaks, tokenStarts[::columnCount])
+        lastLine = np.searchsorted(lineBreaks, tokenStarts[columnCount-1::columnCount])
+        irregular = firstLine != lastLine
+        irregular[1:] |= firstLine[1:] == lastLine[:-1]
+        if irregular.any():
+            raise ValueError("_atom_site row near byte %d doesn't have %d fields"
+                    % (offset + tokenStarts[np.argmax(irregular) * columnCount], columnCount))
+        tokenStarts = tokenStarts.reshape(-1, columnCount)
+        tokenEnds = tokenEnds.reshape(-1, columnCount)
+
+        def gather(column, rows=None):
+            first = tokenStarts[:, column]
+            last = tokenEnds[:, column]
+            if rows is not None:
+                first, last = first[rows], last[rows]
+            return gatherTokens(data, first, last)
+
+        # Split the rows by kind and keep those of the wanted model
+        selected = np.ones(len(tokenStarts), dtype=bool)
+        if modelColumn is not None:
+            selected = gather(modelColumn) == model.encode("ascii")
+        isHetatm = np.zeros(len(tokenStarts), dtype=bool)
+        if groupColumn is not None:
+            isHetatm = gather(groupColumn) == b"HETATM"
+        for kind, rows in ((cifreader.ATOM, selected & ~isHetatm), (cifreader.HETATM, selected & isHetatm)):
+            if kind not in kinds or not rows.any():
+                continue
+            rows = None if rows.all() else np.flatnonzero(rows)
+            yield Block(kind, [None if column is None else gather(column, rows) for column in columns])
+
+#################################################################################
+# Copy the tokens between the offsets first and last (one token per row) out of data into
+# a fixed-width bytes array, padded with NUL bytes (which NumPy strips)
+def gatherTokens(data, first, last):
+    if len(first) == 0:
+        return np.zeros(0, dtype="S1")
+    width = max(int((last - first).max()), 1)
+    offsets = first[:, None] + np.arange(width)
+    chars = data[np.minimum(offsets, len(data) - 1)]
+    chars[offsets >= last[:, None]] = 0
+    return np.ascontiguousarray(chars).view("S%d" % width).reshape(-1)
@@ -0,0 +1,300 @@
+"""
+asyncio OSC streaming engine. Plays several structures at once from one process.
+
+Each loaded structure is a Stream with its own cursor, so nothing is kept in module
+globals. The values sent for every atom (and where a new asym, entity or chain starts) are
+compiled into a Timeline when the stream is created, so a tick only walks arrays. All streams
+share one UDP transport and are scheduled on one event loop, each on its own drift-free
+schedule (scheduler.Scheduler) with future timetags.
+
+Optionally (Stream.cachePackets) every bundle of a pass is encoded once into a PacketCache,
+so looping playback is just a timetag patch and a sendto of a memoryview slice.
+
+When more than one structure plays, each stream's addresses are prefixed (e.g.
+/s1/BFactor, /s2/BFactor) so the Pd patch can tell them apart.
+
+With useContacts the stream also sends the local packing density of every atom (/density)
+and, on each new chain, the number of residues its residue touches (/contacts). Both are
+computed once per structure with a spatial grid index (contacts.py).
+
+With useLigands (for structures read with their ligands, Structure.hetatms) the stream
+also sends a /ligand event with the ligand's residue name (e.g. "9DK") on the tick that
+reaches a residue bound to a ligand (contacts.ligandContacts).
+
+A stream can also play a structure aggregated by residue (atomtable.residueStructure): one
+tick per residue, /BFactor sending the mean B factor, plus /maxBFactor and /atomCount.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import asyncio
+import struct
+import time
+import numpy as np
+from pythonosc import osc_message_builder
+from pythonosc import osc_bundle_builder
+import scheduler
+import contacts
+import atomtable
+
+#################################################################################
+# Build one OSC bundle from a list of (address, value) messages
+def buildBundle(messages, timetag):
+    bundle = osc_bundle_builder.OscBundleBuilder(timetag)
+    for address, value in messages:
+        message = osc_message_builder.OscMessageBuilder(address=address)
+        message.add_arg(value)
+        bundle.add_content(message.build())
+    return bundle.build()
+
+#################################################################################
+# Everything a stream sends, computed once per structure so playback does no lookups.
+# One array of ready-to-send values per message, plus flags marking the atoms where a
+# new asym, entity or chain starts. The flags wrap around: atom 0 is compared against
+# the last atom, as it is when the playback loops.
+# With useContacts the packing density and residue contacts of every atom are added, with
+# useLigands the ligand bound to its residue and the atoms where a new residue starts.
+class Timeline(object):
+    def __init__(self, structure, hydroVals, aaCategories, useContacts=False, useLigands=False):
+        atoms, structIndex = structure.atoms, structure.structIndex
+        self.atoms = atoms
+        self.bfactor = atoms.bfactor.astype(np.float64)
+        self.hydro = atoms.mapResidues(hydroVals)
+        self.category = atoms.mapResidues(aaCategories, dtype=np.int8)
+        # Structure type of each atom (0 = helix, 1 = sheet, 2 = loop)
+        self.structType = atoms.structTypes(structIndex)
+        self.newAsym = changed(atoms.asymCodes)
+        self.newEntity = changed(atoms.entity)
+        self.newChain = changed(atoms.seqId)
+        self.maxBfactor = None
+        self.atomCount = None
+        if isinstance(atoms, atomtable.ResidueTable):
+            self.maxBfactor = atoms.maxBfactor.astype(np.float64)
+            self.atomCount = atoms.atomCount
+        self.density = None
+        self.contacts = None
+        if useContacts:
+            self.density, self.contacts = contacts.contactColumns(atoms)
+        self.ligand = None
+        self.ligandNames = None
+        self.newResidue = None
+        if useLigands:
+            if structure.hetatms is None:
+                raise ValueError("the structure was parsed without ligands")
+            self.ligand = contacts.ligandContacts(atoms, structure.hetatms)
+            self.ligandNames = list(structure.hetatms.residues)
+            self.newResidue = changed(atoms.residueKeys())
+
+    def __len__(self):
+        return len(self.bfactor)
+
+    # The columns as plain Python lists, which are the cheapest to index one at a time
+    def lists(self):
+        return (self.bfactor.tolist(), self.hydro.tolist(), self.category.tolist(),
+                self.structType.tolist(), self.newAsym.tolist(), self.newEntity.tolist(),
+                self.newChain.tolist())
+
+# True where a value differs from the one before it (cyclically)
+def changed(values):
+    return values != np.roll(values, 1)
+
+#################################################################################
+# One structure being played: its precomputed timeline plus its own cursor
+class Stream(object):
+    def __init__(self, structure, hydroVals, aaCategories, name="", prefix="", useContacts=False,
+            useLigands=False):
+        self.timeline = Timeline(structure, hydroVals, aaCategories, useContacts, useLigands)
+        self.atoms = self.timeline.atoms
+        self.name = name
+        self.prefix = prefix
+
+        (self.bfactors, self.hydros, self.categories, self.structTypes, self.newAsyms,
+                self.newEntities, self.newChains) = self.timeline.lists()
+        self.maxBfactors = None
+        self.atomCounts = None
+        if self.timeline.atomCount is not None:
+            self.maxBfactors = self.timeline.maxBfactor.tolist()
+            self.atomCounts = self.timeline.atomCount.tolist()
+        self.densities = None
+        self.contactCounts = None
+        if useContacts:
+            self.densities = self.timeline.density.tolist()
+            self.contactCounts = self.timeline.contacts.tolist()
+        # Name of the ligand bound to the residue of each atom (None when there is none)
+        self.ligands = None
+        self.newResidues = None
+        if useLigands:
+            names = self.timeline.ligandNames
+            self.ligands = [names[ligand] if ligand >= 0 else None for ligand in self.timeline.ligand.tolist()]
+            self.newResidues = self.timeline.newResidue.tolist()
+
+        # Addresses of the messages
+        self.BFactorAddress = prefix + "/BFactor"
+        self.hydroAddress = prefix + "/hydrophobicity"
+        self.newAsymAddress = prefix + "/newAsym"
+        self.newEntityAddress = prefix + "/newEntity"
+        self.newChainAddress = prefix + "/newChain"
+        self.categoryAddress = prefix + "/category"
+        self.structTypeAddress = prefix + "/structType"
+        self.maxBFactorAddress = prefix + "/maxBFactor"
+        self.atomCountAddress = prefix + "/atomCount"
+        self.densityAddress = prefix + "/density"
+        self.contactsAddress = prefix + "/contacts"
+        self.ligandAddress = prefix + "/ligand"
+
+        self.iterator = 0
+        self.started = False # The first tick announces a new asym, entity and chain
+        self.current = 0 # Atom of the last tick (for status output)
+        self.structTypeMsg = 5 # Initialize a value higher than the one used for message (0,1,2)
+        self.categoryMsg = 8 # Initialize a value higher than the one used for message (0,1,2,3,4)
+        self.packets = None # PacketCache, see cachePackets()
+
+    def __len__(self):
+        return len(self.timeline)
+
+    # Messages for atom i, in send order. On the first tick every "new" message is sent.
+    def messagesAt(self, i, first=False):
+        # B Factor and hydrophobicity every tick
+        # NOTE: to send the hydrophobicity only when it changes, add a "new hydro" flag to 
+        # the timeline like the ones below. DO NOT DELETE
+        messages = [(self.BFactorAddress, self.bfactors[i]), (self.hydroAddress, self.hydros[i])]
+        if self.atomCounts is not None:
+            messages.append((self.maxBFactorAddress, self.maxBfactors[i]))
+            messages.append((self.atomCountAddress, self.atomCounts[i]))
+        if self.densities is not None:
+            messages.append((self.densityAddress, self.densities[i]))
+
+        if first or self.newAsyms[i]:
+            messages.append((self.newAsymAddress, True))
+        if first or self.newEntities[i]:
+            messages.append((self.newEntityAddress, True))
+        # New chain: send its category and structure type too
+        if first or self.newChains[i]:
+            messages.append((self.newChainAddress, True))
+            messages.append((self.categoryAddress, self.categories[i]))
+            messages.append((self.structTypeAddress, self.structTypes[i]))
+            if self.contactCounts is not None:
+                messages.append((self.contactsAddress, self.contactCounts[i]))
+        # New residue bound to a ligand: send the ligand's name
+        if self.ligands is not None and (first or self.newResidues[i]) and self.ligands[i] is not None:
+            messages.append((self.ligandAddress, self.ligands[i]))
+        return messages
+
+    # Advance the cursor, looping back to the beginning at the end of the structure.
+    # Returns the atom to play and whether it is the very first tick.
+    def advance(self):
+        i = self.iterator
+        first = not self.started
+        self.started = True
+        if first or self.newChains[i]:
+            self.categoryMsg = self.categories[i]
+            self.structTypeMsg = self.structTypes[i]
+        self.current = i
+        self.iterator = (i + 1) % len(self.bfactors)
+        return i, first
+
+    # Messages for the current atom, in send order. Advances the cursor.
+    def nextMessages(self):
+        i, first = self.advance()
+        return self.messagesAt(i, first)
+
+    # Bundle for the current atom, stamped with timetag
+    def nextBundle(self, timetag):
+        return buildBundle(self.nextMessages(), timetag)
+
+    # Encode the whole loop into a PacketCache so that playback only patches timetags
+    def cachePackets(self):
+        self.packets = PacketCache(self)
+
+    # Encoded bundle (bytes-like) for the current atom, stamped with timetag. Comes from
+    # the packet cache when there is one.
+    def nextDatagram(self, timetag):
+        if self.packets is None:
+            return self.nextBundle(timetag).dgram
+        i, first = self.advance()
+        return self.packets.packet(i, first, timetag)
+
+    # One line describing the last tick
+    def status(self):
+        i = self.current
+        return "%sCategory: %s  Structure Type: %s  Asym: %s  Entity: %s  Chain: %s" % (
+                self.name + "  " if self.name else "", self.categoryMsg, self.structTypeMsg,
+                self.atoms.asym(i), self.atoms.entity[i], self.atoms.seqId[i])
+
+#################################################################################
+# Every bundle of one pass through a stream, encoded once into a single contiguous buffer
+# with an offset index. Playing a tick writes its timetag into the buffer and returns a
+# memoryview slice to sendto, so the steady state does no allocation or encoding.
+class PacketCache(object):
+    def __init__(self, stream):
+        packets = [buildBundle(stream.messagesAt(i), osc_bundle_builder.IMMEDIATELY).dgram
+                for i in range(len(stream))]
+        offsets = np.zeros(len(packets) + 1, dtype=np.int64)
+        np.cumsum([len(packet) for packet in packets], out=offsets[1:])
+        self.offsets = offsets.tolist()
+        self.buffer = bytearray(b"".join(packets))
+        self.view = memoryview(self.buffer)
+
+        # The very first tick also announces the first asym, entity and chain
+        self.first = bytearray(buildBundle(stream.messagesAt(0, True), osc_bundle_builder.IMMEDIATELY).dgram)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    # Bundle of atom i stamped with timetag (seconds since the epoch)
+    def packet(self, i, first, timetag):
+        if first:
+            packTimetag(self.first, 0, timetag)
+            return memoryview(self.first)
+        start = self.offsets[i]
+        packTimetag(self.buffer, start, timetag)
+        return self.view[start:self.offsets[i+1]]
+
+# OSC timetags are NTP times: seconds since 1900 and a 32 bit fraction. In a bundle the
+# timetag follows the 8 byte "#bundle" header.
+ntpEpochOffset = 2208988800
+timetagFormat = struct.Struct(">II")
+
+def packTimetag(buffer, start, timetag):
+    seconds = int(timetag)
+    fraction = int((timetag - seconds) * 4294967296) & 0xFFFFFFFF
+    timetagFormat.pack_into(buffer, start + 8, seconds + ntpEpochOffset, fraction)
+
+#################################################################################
+# Plays any number of streams over one UDP transport on one event loop
+class Engine(object):
+    def __init__(self, ip, port, latency=0.05, onTick=None):
+        self.ip = ip
+        self.port = port
+        self.latency = latency
+        self.onTick = onTick    # Called with (stream, scheduler, seconds taken) after each tick
+        self.streams = []       # (stream, scheduler) pairs
+        self.transport = None
+
+    # Add a stream played every `period` seconds. Returns its scheduler so the tempo can
+    # be changed while playing.
+    def add(self, stream, period):
+        ticks = scheduler.Scheduler(period, self.latency)
+        self.streams.append((stream, ticks))
+        return ticks
+
+    async def play(self, stream, ticks):
+        while True:
+            deadline = ticks.next()
+            delay = ticks.delay(deadline)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            deadline = ticks.sent(deadline)
+            start = time.perf_counter()
+            self.transport.sendto(stream.nextDatagram(ticks.timetag(deadline)))
+            if self.onTick is not None:
+                self.onTick(stream, ticks, time.perf_counter() - start)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.ip, self.port))
+        try:
+            await asyncio.gather(*[self.play(stream, ticks) for stream, ticks in self.streams])
+        finally:
+            self.transport.close()
+            self.transport = None
@@ -0,0 +1,272 @@
+"""
+Parity check of the readers: every way of reading a file must give the same Structure.
+
+Fixtures are made from 5nx2.txt in a temporary directory:
+    permuted     the columns of the _atom_site, _struct_conf and _struct_sheet_range loops
+                 in reverse order
+    multimodel   the _atom_site rows repeated as models 1 to 3 (pdbx_PDB_model_num), each
+                 model moved a little
+    legacy       a fixed-width PDB file written from 5nx2.txt. Its first chain is numbered
+                 from -authorOffset, so its first helix crosses 0, and has insertion codes
+                 on a stretch of residues (k, kA, kB, then k+1 for label k+3, as in Kabat
+                 numbering) and in its helix and sheet ranges
+Each mmCIF file is read with atomtable.readStructure (streamed through the section index),
+readStructure(mapped=True) (mmapreader) and a plain pass of cifreader.readRecords over the
+whole file, for every model and with the ligands and waters. The permuted file must also
+read the same as 5nx2.txt, and the legacy file the same as 5nx2.txt (except the residue
+numbers of the HETATM atoms, which mmCIF leaves out, and the residue numbers of the first
+chain, which must be those of 5nx2.txt moved by a constant). Besides the tables and the
+secondary structure index, the structure type of every atom is compared.
+    python paritycheck.py
+prints one line per comparison and exits with status 1 when any of them differ.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+import atomtable
+import cifreader
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Structure the fixtures are made from
+sourceFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "5nx2.txt")
+
+# Loops whose columns are reversed in the permuted fixture
+permutedCategories = ("_atom_site", "_struct_conf", "_struct_sheet_range")
+
+# Number of models of the multi-model fixture and the distance (Angstroms) between them
+modelCount = 3
+modelOffset = 0.5
+
+# Residues after the first one of the first chain where the insertion codes start
+insertionStart = 10
+
+# Author number of the first residue of the first chain in the legacy fixture is
+# -authorOffset
+authorOffset = 5
+
+#################################################################################
+# FIXTURES ######################################################################
+# Field names of the _atom_site loop of lines and the line numbers of its rows
+def atomRows(lines):
+    headers = [line.split()[0].partition(".")[2] for line in lines if line.startswith("_atom_site.")]
+    rows = [n for n, line in enumerate(lines) if line.startswith(("ATOM ", "HETATM"))]
+    return headers, rows
+
+# Write a copy of source with the columns of the loops of categories in reverse order
+def permutedFile(path, source=sourceFile, categories=permutedCategories):
+    with open(source, 'r') as file:
+        lines = file.readlines()
+    output = []
+    n = 0
+    while n < len(lines):
+        category = lines[n].split(".", 1)[0]
+        if category not in categories or not output or output[-1].strip() != "loop_":
+            output.append(lines[n])
+            n += 1
+            continue
+        headers = []
+        while lines[n].startswith(category + "."):
+            headers.append(lines[n])
+            n += 1
+        output.extend(reversed(headers))
+        while n < len(lines) and not lines[n].startswith(("#", "_", "loop_", "data_")):
+            output.append(" ".join(reversed(lines[n].split())) + "\n")
+            n += 1
+    with open(path, 'w') as file:
+        file.writelines(output)
+
+# Write a copy of source with its _atom_site rows repeated as models 1 to count. Each model
+# gets new site numbers and is moved offset along x.
+def multiModelFile(path, source=sourceFile, count=modelCount, offset=modelOffset):
+    with open(source, 'r') as file:
+        lines = file.readlines()
+    headers, rows = atomRows(lines)
+    siteColumn = headers.index("id")
+    xColumn = headers.index("Cartn_x")
+    modelColumn = headers.index(cifreader.MODEL_FIELD)
+    rowFields = [lines[n].split() for n in rows]
+
+    site = 0
+    with open(path, 'w') as file:
+        file.writelines(lines[:rows[0]])
+        for model in range(1, count + 1):
+            for row in rowFields:
+                site += 1
+                row = list(row)
+                row[siteColumn] = str(site)
+                row[xColumn] = "%.3f" % (float(row[xColumn]) + (model - 1) * offset)
+                row[modelColumn] = str(model)
+                file.write(" ".join(row) + "\n")
+        file.writelines(lines[rows[-1]+1:])
+
+# Author residue number and insertion code of a label residue number of the renumbered
+# chain (first is its first residue). The chain is numbered from -authorOffset; up to
+# k = insertionStart - authorOffset the numbers follow, the next two become kA and kB and
+# the rest move back by two.
+def authorNumber(seq, first):
+    seq -= first + authorOffset
+    start = insertionStart - authorOffset
+    if seq <= start:
+        return seq, " "
+    if seq <= start + 2:
+        return start, "AB"[seq - start - 1]
+    return seq - 2, " "
+
+# Write source as a legacy PDB file (chains are the label asyms, residue numbers the label
+# residue numbers) with negative numbers and insertion codes on the first chain, see
+# authorNumber(). Returns the first chain and how far its residue numbers were moved back.
+def legacyFile(path, source=sourceFile):
+    records = list(cifreader.readRecords(source))
+    atoms = [record for record in records if record.kind in (cifreader.ATOM, cifreader.HETATM)]
+    ranges = [record for record in records if record.kind in (cifreader.HELIX, cifreader.SHEET)]
+    chain = atoms[0].fields[cifreader.ASYM]
+    first = min(int(record.fields[cifreader.SEQ]) for record in atoms
+            if record.kind == cifreader.ATOM and record.fields[cifreader.ASYM] == chain)
+    def number(asym, seq):
+        if asym == chain:
+            return authorNumber(int(seq), first)
+        return int(seq), " "
+
+    with open(path, 'w') as file:
+        # Chains of each entity
+        entities = {}
+        for record in atoms:
+            chains = entities.setdefault(record.fields[cifreader.ENTITY], [])
+            if record.fields[cifreader.ASYM] not in chains:
+                chains.append(record.fields[cifreader.ASYM])
+        continuation = ""
+        for entity, chains in sorted(entities.items()):
+            for text in ("MOL_ID: %s;" % entity, "CHAIN: %s;" % ", ".join(chains)):
+                file.write("COMPND %3s%s\n" % (continuation, text))
+                continuation = str(int(continuation or "1") + 1)
+
+        for n, record in enumerate(ranges, 1):
+            asym, begin, endAsym, end = record.fields
+            begin, beginCode = number(asym, begin)
+            end, endCode = number(endAsym, end)
+            if record.kind == cifreader.HELIX:
+                file.write("HELIX  %3d %3d XXX %s %4d%s XXX %s %4d%s  1\n"
+                        % (n, n, asym, begin, beginCode, endAsym, end, endCode))
+            else:
+                file.write("SHEET  %3d %3s 1 XXX %s%4d%s XXX %s%4d%s  0\n"
+                        % (n, "A", asym, begin, beginCode, endAsym, end, endCode))
+
+        # HETATM residues have no label number: number them in order
+        hetatmResidue = None
+        hetatmNumber = 0
+        for record in atoms:
+            site, name, residue, asym, entity, seq, bfactor, x, y, z = record.fields
+            if record.kind == cifreader.HETATM:
+                if (asym, residue, seq) != hetatmResidue:
+                    hetatmResidue = (asym, residue, seq)
+                    hetatmNumber += 1
+                seq, code = hetatmNumber, " "
+            else:
+                seq, code = number(asym, seq)
+            if name[0] in "'\"":
+                # Quoted in mmCIF, e.g. "C1'"
+                name = name[1:-1]
+            file.write("%-6s%5d %-4s %3s %s%4d%s   %8s%8s%8s%6s%6s\n" % ("ATOM" if record.kind == cifreader.ATOM
+                    else "HETATM", int(site), name, residue, asym, seq, code, x, y, z, "1.00", bfactor))
+        file.write("END\n")
+    return chain, first + authorOffset
+
+#################################################################################
+# READERS #######################################################################
+# Structure of a file from a plain pass of cifreader.readRecords over the whole file, with
+# every HETATM atom in the hetatms table
+def readFullPass(path, model=None):
+    structIndex = {}
+    hetatms = atomtable.TableBuilder()
+    def onRecord(record):
+        if record.kind == cifreader.HETATM:
+            hetatms.add(record.fields)
+        else:
+            cifreader.addStructRange(structIndex, record)
+    atoms = atomtable.buildTable(cifreader.readRecords(path, model=model), onRecord=onRecord)
+    return atomtable.Structure(atoms, structIndex, hetatms.table())
+
+def readStreamed(path, model=None):
+    return atomtable.readStructure(path, model=model, ligands=True, waters=True)
+
+def readMapped(path, model=None):
+    return atomtable.readStructure(path, model=model, ligands=True, waters=True, mapped=True)
+
+#################################################################################
+# COMPARISON ####################################################################
+# Every column of a table with the label codes replaced by their labels
+def tableValues(table):
+    values = {}
+    for name in ("site", "entity", "seqId", "bfactor", "coords"):
+        values[name] = getattr(table, name)
+    for name, codes, labels in (("atom", table.atomCodes, table.atomNames),
+            ("residue", table.residueCodes, table.residues), ("asym", table.asymCodes, table.asyms)):
+        values[name] = np.array(list(labels) + [""], dtype=object)[codes]
+    return values
+
+# The structure with the residue numbers of chain moved by offset, in the table and the
+# secondary structure index
+def shiftResidues(structure, chain, offset):
+    atoms = structure.atoms
+    arrays = atoms.arrays()
+    arrays["seqId"] = atoms.seqId + np.where(atoms.asymCodes == atoms.asyms.index(chain), offset, 0).astype(np.int32)
+    structIndex = {}
+    for (asym, seq), structType in structure.structIndex.items():
+        structIndex[(asym, seq + offset if asym == chain else seq)] = structType
+    return structure._replace(atoms=atomtable.AtomTable.fromColumns(arrays, atoms.labels()),
+            structIndex=structIndex)
+
+# Names of the parts of two structures that differ. ignore holds the names (e.g. "seqId",
+# "hetatm.seqId" or "structIndex") not to compare.
+def differences(first, second, ignore=()):
+    found = []
+    if "structIndex" not in ignore and first.structIndex != second.structIndex:
+        found.append("structIndex")
+    if not np.array_equal(first.atoms.structTypes(first.structIndex), second.atoms.structTypes(second.structIndex)):
+        found.append("structType")
+    for prefix, a, b in (("", first.atoms, second.atoms), ("hetatm.", first.hetatms, second.hetatms)):
+        a, b = tableValues(a), tableValues(b)
+        for name in a:
+            if prefix + name not in ignore and not np.array_equal(a[name], b[name]):
+                found.append(prefix + name)
+    return found
+
+# Compare two structures and print the outcome. Returns True when they are the same.
+def check(label, first, second, ignore=()):
+    found = differences(first, second, ignore)
+    print("%-52s %6d atoms  %s" % (label, len(first.atoms), "DIFFERS: " + ", ".join(found) if found else "ok"))
+    return not found
+
+#################################################################################
+# Main Loop
+def main():
+    passed = True
+    with tempfile.TemporaryDirectory(prefix="wiac-parity-") as directory:
+        permuted = os.path.join(directory, "permuted.cif")
+        permutedFile(permuted)
+        multimodel = os.path.join(directory, "multimodel.cif")
+        multiModelFile(multimodel)
+        legacy = os.path.join(directory, "legacy.pdb")
+        chain, offset = legacyFile(legacy)
+
+        for name, path, models in (("5nx2", sourceFile, (None, 1)), ("permuted", permuted, (None, 1)),
+                ("multimodel", multimodel, (None,) + tuple(range(1, modelCount + 1)))):
+            for model in models:
+                label = "%s model %s" % (name, "all" if model is None else model)
+                reference = readFullPass(path, model)
+                passed &= check(label + ": streamed vs full pass", readStreamed(path, model), reference)
+                passed &= check(label + ": mapped vs full pass", readMapped(path, model), reference)
+        passed &= check("permuted vs 5nx2", readStreamed(permuted), readStreamed(sourceFile))
+        legacyStructure = readStreamed(legacy)
+        passed &= check("legacy vs 5nx2", legacyStructure, readStreamed(sourceFile),
+                ignore=("seqId", "structIndex", "hetatm.seqId"))
+        passed &= check("legacy vs 5nx2: residue numbers", shiftResidues(legacyStructure, chain, offset),
+                readStreamed(sourceFile), ignore=("hetatm.seqId",))
+    if not passed:
+        sys.exit(1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,272 @@
+"""
+On-disk cache of parsed structures, so files that haven't changed are not reparsed.
+
+Each entry is keyed on the SHA-256 of the file content, atomtable.parserVersion and the
+fields/options the file was parsed with. An entry is a directory holding one .npy file per
+table column (the HETATM table's columns prefixed with "hetatm.") plus the secondary
+structure index, and a meta.json with the label lists.
+A warm load memory-maps the .npy files instead of parsing the mmCIF text.
+
+The cache is kept under a total size limit by evicting the least recently used entries.
+Sizing the whole cache means listing every entry, so it is done at most once every
+evictInterval seconds (across all processes, see evictIfDue) rather than on every store;
+in between the cache can grow past the limit by the entries stored in the meantime.
+Its location and size limit can be set with the WIAC_CACHE_DIR and WIAC_CACHE_MB
+environment variables.
+
+Entries can also be kept in another directory (the directory argument of readStructure),
+which is never evicted: its owner removes the entries it no longer needs with prune(). A
+pdb2json batch export keeps its parsed structures next to its manifest this way, since
+the 1 GB default limit is far smaller than a parsed mirror of the PDB.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import atomtable
+import cifreader
+import profiling
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+cacheDir = os.environ.get("WIAC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "wiac"))
+maxBytes = int(float(os.environ.get("WIAC_CACHE_MB", "1024")) * 1024 * 1024)
+
+# Name of the metadata file in each entry. Its modification time marks the last use.
+metaName = "meta.json"
+
+# Prefix of the HETATM table's arrays in an entry
+hetatmPrefix = "hetatm."
+
+# Seconds between two evictions, and the file in cacheDir whose modification time marks
+# the last one
+evictInterval = 60
+evictMarker = ".evicted"
+
+#################################################################################
+# Hash the content of a file without reading it into memory all at once
+def contentHash(path, blockSize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        block = file.read(blockSize)
+        while block:
+            digest.update(block)
+            block = file.read(blockSize)
+    return digest.hexdigest()
+
+# Cache key for a file parsed with the given options
+def cacheKey(path, options):
+    settings = {
+        "parserVersion": atomtable.parserVersion,
+        "atomFields": cifreader.ATOM_FIELDS,
+        "rangeFields": cifreader.RANGE_FIELDS,
+        "options": options,
+    }
+    digest = hashlib.sha256(contentHash(path).encode("ascii"))
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+#################################################################################
+# Convert the secondary structure index to arrays and back
+def structArrays(structIndex):
+    asyms = sorted(set(asym for asym, _ in structIndex))
+    asymCodes = {}
+    for code, asym in enumerate(asyms):
+        asymCodes[asym] = code
+    keys = sorted(structIndex)
+    arrays = {
+        "structAsym": np.array([asymCodes[asym] for asym, _ in keys], dtype=np.uint16),
+        "structSeq": np.array([seq for _, seq in keys], dtype=np.int32),
+        "structType": np.array([structIndex[key] for key in keys], dtype=np.int8),
+    }
+    return arrays, asyms
+
+def structIndexFromArrays(arrays, asyms):
+    structIndex = {}
+    for code, seq, structType in zip(arrays["structAsym"].tolist(), arrays["structSeq"].tolist(),
+            arrays["structType"].tolist()):
+        structIndex[(asyms[code], seq)] = structType
+    return structIndex
+
+#################################################################################
+# Load an entry from directory (cacheDir by default), memory-mapping its arrays. Returns
+# None on a miss.
+def load(key, directory=None):
+    entry = os.path.join(directory or cacheDir, key)
+    metaPath = os.path.join(entry, metaName)
+    try:
+        with open(metaPath, 'r') as file:
+            meta = json.load(file)
+        arrays = {}
+        for name in meta["arrays"]:
+            arrays[name] = np.load(os.path.join(entry, name + ".npy"), mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # Mark the entry as recently used
+    try:
+        os.utime(metaPath)
+    except OSError:
+        pass
+
+    atoms = tableFromArrays(arrays, meta["labels"])
+    hetatms = None
+    if meta.get("hetatmLabels") is not None:
+        hetatms = tableFromArrays(arrays, meta["hetatmLabels"], hetatmPrefix)
+    return atomtable.Structure(atoms, structIndexFromArrays(arrays, meta["structAsyms"]), hetatms)
+
+def tableFromArrays(arrays, labels, prefix=""):
+    tableArrays = {}
+    for name in atomtable.arrayColumns:
+        tableArrays[name] = arrays[prefix + name]
+    return atomtable.AtomTable.fromColumns(tableArrays, labels)
+
+# Store a parsed structure in directory (cacheDir by default). The entry is written to a
+# temporary directory and renamed into place so readers (and other processes) never see a
+# half written entry. Only cacheDir is evicted.
+def store(key, structure, directory=None):
+    evicting = directory is None
+    directory = directory or cacheDir
+    os.makedirs(directory, exist_ok=True)
+    arrays = structure.atoms.arrays()
+    structureArrays, structAsyms = structArrays(structure.structIndex)
+    arrays.update(structureArrays)
+    hetatmLabels = None
+    if structure.hetatms is not None:
+        for name, array in structure.hetatms.arrays().items():
+            arrays[hetatmPrefix + name] = array
+        hetatmLabels = structure.hetatms.labels()
+
+    temp = tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp, name + ".npy"), np.ascontiguousarray(array))
+        meta = {
+            "arrays": sorted(arrays),
+            "labels": structure.atoms.labels(),
+            "structAsyms": structAsyms,
+            "hetatmLabels": hetatmLabels,
+        }
+        with open(os.path.join(temp, metaName), 'w') as file:
+            json.dump(meta, file)
+        os.rename(temp, os.path.join(directory, key))
+    except OSError:
+        # Another process stored the same entry first, or the disk is full
+        shutil.rmtree(temp, ignore_errors=True)
+        return
+    if evicting:
+        evictIfDue()
+
+#################################################################################
+# Size of an entry in bytes
+def entrySize(entry):
+    size = 0
+    for name in os.listdir(entry):
+        size += os.path.getsize(os.path.join(entry, name))
+    return size
+
+# Evict when the last eviction (by any process) was more than evictInterval seconds ago.
+# Costs one stat otherwise.
+def evictIfDue():
+    marker = os.path.join(cacheDir, evictMarker)
+    try:
+        if time.time() - os.path.getmtime(marker) < evictInterval:
+            return
+    except OSError:
+        pass
+    try:
+        # Mark first so that other processes don't start evicting too
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+    except OSError:
+        return
+    evict()
+
+# Remove the least recently used entries until the cache fits in limit bytes
+def evict(limit=None):
+    if limit is None:
+        limit = maxBytes
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(cacheDir)
+    except OSError:
+        return
+    for name in names:
+        entry = os.path.join(cacheDir, name)
+        try:
+            if name.startswith(".tmp-"):
+                # Leftovers of an interrupted store
+                if time.time() - os.path.getmtime(entry) > 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            if name.startswith("."):
+                continue
+            size = entrySize(entry)
+            used = os.path.getmtime(os.path.join(entry, metaName))
+        except OSError:
+            continue
+        entries.append((used, size, entry))
+        total += size
+
+    entries.sort()
+    for used, size, entry in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+# Remove every entry
+def clear():
+    evict(0)
+
+# Remove the entries of directory whose keys are not in keep, and the leftovers of
+# interrupted stores
+def prune(directory, keep):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        entry = os.path.join(directory, name)
+        if name.startswith(".tmp-"):
+            try:
+                if time.time() - os.path.getmtime(entry) > 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                pass
+        elif name not in keep:
+            shutil.rmtree(entry, ignore_errors=True)
+
+#################################################################################
+# Cache key of a file parsed with the options of readStructure. It changes whenever the
+# file or anything it parses to does, so callers can use it to tell if their own outputs
+# are up to date (see pdb2json).
+def structureKey(path, skipAtoms=atomtable.BACKBONE, secondaryStructure=True, coordinates=True,
+        model=None, ligands=False, waters=False):
+    options = {"skipAtoms": sorted(skipAtoms), "secondaryStructure": secondaryStructure,
+            "coordinates": coordinates, "model": model, "ligands": ligands, "waters": waters}
+    return cacheKey(path, options)
+
+# Drop-in replacement for atomtable.readStructure that goes through the cache. mapped only
+# changes how a file is read, not what it parses to, so it is not part of the key. key is
+# the structureKey() of the file with these options when the caller already has it.
+# directory is where the entry is kept, cacheDir by default (see prune()).
+def readStructure(path, skipAtoms=atomtable.BACKBONE, secondaryStructure=True, coordinates=True,
+        model=None, ligands=False, waters=False, mapped=False, key=None, directory=None):
+    with profiling.stage("cache lookup"):
+        if key is None:
+            key = structureKey(path, skipAtoms, secondaryStructure, coordinates, model, ligands, waters)
+        structure = load(key, directory)
+    if structure is None:
+        structure = atomtable.readStructure(path, skipAtoms, secondaryStructure, coordinates,
+                model, ligands, waters, mapped)
+        with profiling.stage("cache store"):
+            store(key, structure, directory)
+    return structure
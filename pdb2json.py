@@ -4,6 +4,37 @@ NOTE: .cif or .pdb files must first be made plain text in order for the script t
 
 This version creates a JSON file in which you will find the data entries for amino acid
 category, structure type (helix/sheet/loop), chain number, asym letter, and entity number.
+The same data can also be exported to a compact binary columnar file (see pushBinary) that
+the consumer can memory-map instead of parsing JSON.
+
+With --coords the atom positions are exported too ("position": [x, y, z] in each JSON entry,
+a float32 (N, 3) "coords" column in the binary file), so the visuals don't need to parse
+the file again. With --contacts each entry also gets the local packing density and residue
+contacts of the atom (see contacts.py).
+
+With --residues there is one entry per residue instead of one per side chain atom, holding
+the residue's number (seqId), atom count, mean and max B factor (and its centroid with
+--coords), which makes the export several times smaller.
+
+With --ligands (and/or --waters) the HETATM atoms of ligands (and waters) are written to a
+separate "ligands" list next to "entries", one entry per atom with its residue name (e.g.
+"9DK" or "HOH"). Only the first model of multi-model files is exported unless --model says
+otherwise.
+
+With --mmap mmCIF files are parsed from a memory map (see mmapreader.py), so converting
+very large files needs little more memory than the parsed columns.
+
+Run without arguments to be prompted for a single file. Pass files, directories or glob
+patterns to convert them all in parallel (see batch.py), e.g.
+    python pdb2json.py mirror/ -o exports -j 8 --format binary
+Batch exports are incremental: a manifest.json in the output directory records the inputs
+of every exported file, and the parsed structures are kept next to it in .parsed/ (in the
+format of the parse cache, parsecache.py, but never evicted, only pruned along with the
+manifest). A rerun skips the files whose content, aaCategories and export options haven't
+changed, and re-derives the others from .parsed/ without parsing them again.
+--force exports every file and --no-cache reparses them. Each file is written under its
+input's name, so a batch with two inputs of the same name (e.g. x/1abc.cif and y/1abc.cif,
+or 1abc.cif and 1abc.pdb) stops with an error before anything is written.
 NOTE: All entries are for side chains only. Backbone structures are already being handled 
 in the visual design.
 
@@ -15,50 +46,40 @@ Brian Cantrell, Worldbuilding Media Lab. Oct, 2020.
 """
 
 import os
+import sys
+import argparse
 import json
+import gzip
+import struct
+import hashlib
+import tempfile
+from collections import namedtuple
+import numpy as np
+import atomtable
+import batch
+import contacts
+import parsecache
+import profiling
 
 #GLOBAL VARIABLES ###############################################################
-# Column indices (WARNING: THESE MIGHT CHANGE ACCORDING TO FILE TYPE)
-BFactorCol = 14 #Column for temperature (B Factor)
-atomCol = 3 # Column for atom name
-AACol = 5 # Column for amino acid label
-chainCol = 8 # Column for the chain number
-asymCol = 6 # Column for the asymmetry chain letter
-entityCol = 7 # Column for the entity number
-beginHelix = 5 # Column number for the start of the helix (gives amino acid number)
-endHelix = 9 # Column number for the end of the helix (gives amino acid number)
-beginSheet = 4 # Column number for the beginning AA of the sheet
-endSheet = 8 # Column number for the ending AA of the sheet
-siteNumCol = 1 # Column number for the site number
-
-# Pyhon lists for processing data
-RGroupAAs = [] # List to hold R Group amino acids (used to index hydroVals)
-RGroupChains = [] # List to hold R Group chain numbers (corresponding to amino acid)
-RGroupBFactors = [] # List to hold R Group B factors
-RGroupAsyms = [] # List to hold R Group asym values
-RGroupEntities = [] # List to hold R Group entity values
-categories = []
-structureType = []
-helicesList = [] # List to hold helices for structType
-sheetsList = [] # List to hold sheets for structType
-loopsList = [] # List to hold loops for structType
-siteList = [] # List to hold site numbers
-
-# JSON lists to hold the relevant data
-jsonData = {}
-"""
-jsonData['categories'] = []
-jsonData['AAs'] = [] # List to hold R Group amino acids (used to index hydroVals)
-jsonData['chainNums'] = [] # List to hold R Group chain numbers (corresponding to amino acid)
-jsonData['asyms'] = [] # List to hold R Group asym values
-#jsonData['entities'] = [] # List to hold R Group entity values
-#jsonData['helices'] = [] # List to hold helices for structType
-#jsonData['sheets'] = [] # List to hold sheets for structType
-jsonData['loops'] = [] # List to hold loops for structType
-"""
+# Template for a single JSON entry. Entries are formatted straight from the table columns
+# so no dict is built per atom. The output is the same as json.dump of the entry dicts.
+entryTemplate = '{"site": "%d", "asym": %s, "entity": "%d", "structType": %d, "category": %d}'
+# Optional fields added to the end of each entry: the atom position (mmCIF coordinates
+# have three decimals) and the contact parameters
+positionFields = ', "position": [%.3f, %.3f, %.3f]'
+contactFields = ', "density": %d, "contacts": %d'
+
+# Entry of a residue for the --residues export, and its centroid field
+residueTemplate = ('{"site": "%d", "asym": %s, "entity": "%d", "seqId": %d, "structType": %d, '
+        '"category": %d, "atoms": %d, "meanBFactor": %.2f, "maxBFactor": %.2f}')
+centroidFields = ', "centroid": [%.3f, %.3f, %.3f]'
+
+# Entry of a HETATM (ligand or water) atom in the "ligands" list
+ligandTemplate = '{"site": "%d", "asym": %s, "entity": "%d", "residue": %s, "atom": %s, "BFactor": %.2f}'
 
-# Sentry bool for struct type logic
-isSheet = False
+# Number of entries formatted and written at a time
+chunkSize = 16384
 
 # String to hold the PDB file.
 PDBFile = " " 
@@ -90,152 +111,509 @@ aaCategories = {
 
 #################################################################################
 # Open a file
-def openFile(data):
-    file = open(data, 'r')
-
-    # make global variables visible
-    global jsonData
-    global beginHelix
-    global endHelix
-    global isSheet
-    global RGroupAAs
-    global RGroupChains 
-    global RGroupBFactors 
-    global RGroupAsyms 
-    global RGroupEntities 
-    global helicesList
-    global sheetsList 
-    global loopsList
-
-    # Clear lists just in case...
-    RGroupAAs.clear()
-    RGroupAsyms.clear()
-    RGroupEntities.clear()
-    RGroupChains.clear()
-    categories.clear()
-    helicesList.clear()
-    sheetsList.clear()
-    loopsList.clear()
-    
-    # Open the .cif file NOTE: file must first be made plain text.
-    if file is not None:
-        # Split the file up by line
-        theFile = file.readlines()
-         # Loop over file 
-        for line in theFile:
-            # Split each line on white space
-            entry = line.split()
-
-            ###############################################################################################
-            # Determine whether the current amino acid is part of a helix, loop, or sheet
-            # Check for helix entry first and fill helices list
-            if entry[0] == "HELX_P":
-                firstHAA = int(entry[beginHelix])
-                lastHAA = int(entry[endHelix])
-                # Push the first and last AA number and every number between into helices list
-                for i in range(firstHAA, lastHAA+1):
-                    helicesList.append(i)
-                    
-            # Fill sheets list
-            # First check for last header
-            if entry[0] == "_struct_sheet_range.end_auth_seq_id":
-                # Assign boolean to get sheet values until "#" is reached.
-                # This is necessary because the "#" tag marks the beginning and end of section
-                # TODO: Check to see if sheets are marked out by headers in the first column in other formats.
-                isSheet = True
-            
-            if isSheet == True and entry[0] != "_struct_sheet_range.end_auth_seq_id" and entry[0] != "#":
-                firstSAA = int(entry[beginSheet])
-                lastSAA = int(entry[endSheet])
-                for i in range(firstSAA, lastSAA+1):
-                    sheetsList.append(i)
-            
-            # NOTE: "loops" list comprises any atom not in either sheets or helices. This will be handled 
-            # when looping through the ATOM segment of the data and assigning JSON entries.
-
-            # Check for "#" to set boolean back to false (probably unnecessary but extra security)
-            if entry[0] == "#":
-                isSheet = False
-
-            ###############################################################################################
-            # ATOMs
-            # Select for only those lines listing ATOM coordinates
-            if entry[0] == "ATOM":
-                # Ignore the lines with backbone entries
-                atomName = str(entry[atomCol])
-                atomName.strip()
-
-                if atomName == "CA" or atomName == "C" or atomName == "N" or atomName == "O" or atomName == "CB":
-                    pass
-                # Push R Group amino acid labels and B Factor values to lists
-                else:
-                    # Data values
-                    RGroupAAs.append(entry[AACol])
-                    RGroupAsyms.append(entry[asymCol])
-                    RGroupEntities.append(entry[entityCol])
-                    RGroupChains.append(entry[chainCol])
-                    
-                    # Get the site number to identify atom
-                    siteList.append(entry[siteNumCol]) 
+def openFile(data, coordinates=False, model=1, ligands=False, waters=False, mapped=False):
+    # Stream the helix, sheet and ATOM records from the file NOTE: file must first be made plain text.
+    # The backbone entries are skipped and the R Group atoms go into a columnar table.
+    # Every helix and sheet residue goes into the structure index (asym, residue number) -> structType.
+    # NOTE: "loops" comprise any residue in neither sheets nor helices. This will be handled 
+    # when looking up the structure type while assigning JSON entries.
+    # The x/y/z coordinates are only extracted when asked for, and only the given model is
+    # read (None for all). HETATM ligands and waters go into their own table when asked for.
+    # With mapped=True an mmCIF file is scanned from a memory map (see mmapreader).
+    # Returns an atomtable.Structure so that no parsed data is kept in module globals.
+    return atomtable.readStructure(data, coordinates=coordinates, model=model, ligands=ligands,
+            waters=waters, mapped=mapped)
     
+#################################################################################
+# Incremental writer for the {"entries": [...]} document read by Unity. Entries are written
+# as they are produced, so only one chunk of formatted entries is in memory at a time.
+# The document is written to a temporary file next to path and only renamed to path once
+# it is complete; when writing fails (or is interrupted) the temporary file is removed, so
+# path never holds a truncated document.
+class EntryWriter(object):
+    def __init__(self, path, compress=None):
+        # Compress when asked to, or when the output path ends in .gz
+        if compress is None:
+            compress = path.endswith(".gz")
+        self.path = path
+        self.temp = temporaryPath(path)
+        if compress:
+            self.file = gzip.open(self.temp, 'wt', encoding='utf-8')
+        else:
+            self.file = open(self.temp, 'w', encoding='utf-8')
+        self.empty = True
+        self.file.write('{"entries": [')
+
+    # End the current list and start another one named name, e.g. "ligands"
+    def startList(self, name):
+        self.file.write('], %s: [' % json.dumps(name))
+        self.empty = True
+
+    # Write a chunk of already formatted entries
+    def write(self, entries):
+        text = ", ".join(entries)
+        if not text:
+            return
+        if not self.empty:
+            self.file.write(", ")
+        self.file.write(text)
+        self.empty = False
+
+    # Finish the document and move it into place
+    def close(self):
+        if self.file is not None:
+            self.file.write(']}')
+            self.file.close()
+            self.file = None
+            os.replace(self.temp, self.path)
+
+    # Drop the unfinished document
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.temp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *exc):
+        if excType is None:
+            self.close()
+        else:
+            self.discard()
+
+# Temporary file to write path to before renaming it into place. It is in the same
+# directory (so the rename is atomic) and hidden, with the process ID in its name so
+# batch workers never share one.
+def temporaryPath(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".tmp-%d-%s" % (os.getpid(), name))
+
+#################################################################################
+# Format the JSON entries of atoms [start, stop). columns holds one array per field of the
+# template, in order. labels maps the position of a column holding label codes (e.g. the
+# asym codes) to an array of the JSON encoded labels.
+def formatEntries(template, columns, labels, start, stop):
+    values = [column[start:stop].tolist() for column in columns]
+    for position, encoded in labels.items():
+        values[position] = encoded[columns[position][start:stop]].tolist()
+    return map(template.__mod__, zip(*values))
+
+# JSON encode each label of a label list once
+def encodeLabels(labels):
+    return np.array([json.dumps(label) for label in labels], dtype=object)
+
+# Write the HETATM table of a structure as the "ligands" list
+def writeLigands(writer, hetatms, coordinates=False):
+    template = ligandTemplate[:-1]
+    columns = [hetatms.site, hetatms.asymCodes, hetatms.entity, hetatms.residueCodes,
+            hetatms.atomCodes, hetatms.bfactor]
+    if coordinates:
+        template += positionFields
+        columns.extend(hetatms.coords.T)
+    template += "}"
+    labels = {1: encodeLabels(hetatms.asyms), 3: encodeLabels(hetatms.residues),
+            4: encodeLabels(hetatms.atomNames)}
+
+    writer.startList("ligands")
+    for start in range(0, len(hetatms), chunkSize):
+        stop = min(start + chunkSize, len(hetatms))
+        writer.write(formatEntries(template, columns, labels, start, stop))
+
+#################################################################################
+def pushJSON(structure, outputPath='data.txt', compress=None, coordinates=False, contactParams=False):
+    atoms, structIndex = structure.atoms, structure.structIndex
+    if (coordinates or contactParams) and not atoms.hasCoordinates():
+        raise ValueError("the structure was parsed without coordinates")
+
+    # Set the structure type (0 for helix, 1 for sheets, 2 for loops) and the category of
+    # every atom at once
+    with profiling.stage("classify atoms"):
+        structTypes = atoms.structTypes(structIndex)
+        categories = atoms.mapResidues(aaCategories, dtype=np.int8)
+
+    # Encode each asym label once and index the encoded labels by asym code
+    labels = {1: encodeLabels(atoms.asyms)}
+
+    # The fields of each entry, plus the optional ones. A table aggregated by residue
+    # (atomtable.ResidueTable) gets one entry per residue with its statistics.
+    if isinstance(atoms, atomtable.ResidueTable):
+        template = residueTemplate[:-1]
+        columns = [atoms.site, atoms.asymCodes, atoms.entity, atoms.seqId, structTypes, categories,
+                atoms.atomCount, atoms.bfactor, atoms.maxBfactor]
+        if coordinates:
+            template += centroidFields
+            columns.extend(atoms.coords.T)
     else:
-        print("file is none")
-    
+        template = entryTemplate[:-1]
+        columns = [atoms.site, atoms.asymCodes, atoms.entity, structTypes, categories]
+        if coordinates:
+            template += positionFields
+            columns.extend(atoms.coords.T)
+    if contactParams:
+        template += contactFields
+        with profiling.stage("contacts"):
+            columns.extend(contacts.contactColumns(atoms))
+    template += "}"
+
+    # Open text file and stream the json data to file one chunk at a time
+    with profiling.stage("write JSON"), EntryWriter(outputPath, compress) as writer:
+        for start in range(0, len(atoms), chunkSize):
+            stop = min(start + chunkSize, len(atoms))
+            writer.write(formatEntries(template, columns, labels, start, stop))
+        if structure.hetatms is not None:
+            writeLigands(writer, structure.hetatms, coordinates)
+
 #################################################################################
-def pushJSON():
-    global jsonData
-    jsonData["entries"] = []
-    JSsiteNum = " "
-    JSasym = " "
-    JScat = " "
-    JSstruct = " "
-    JSentity = " "
-
-    for i in range(len(siteList)):
-        # Set values for JSON entries
-        
-        # Set site number 
-        JSsiteNum = siteList[i]
-
-        # Set the structure type
-        curChain = int(RGroupChains[i])
-        if curChain in helicesList:
-            JSstruct = 0 # 0 for helix
-        elif RGroupChains[i] in sheetsList:
-            JSstruct = 1 # 1 for sheets
+# BINARY EXPORT #################################################################
+# Compact alternative to the JSON document. Layout of the file:
+#   16 byte preamble: b"PDBC", uint32 version, uint32 header length, uint32 reserved
+#   UTF-8 JSON header describing the columns (name, dtype, shape, byte offset) and the
+#   labels for categorical columns, padded to the column alignment
+#   Each column as raw little-endian data, starting on a 16 byte boundary
+# The consumer reads the header once and then maps the columns directly with no parsing.
+binaryMagic = b"PDBC"
+binaryVersion = 1
+binaryAlignment = 16
+binaryPreamble = struct.Struct("<4sIII")
+
+# Write named NumPy columns and their labels to a binary columnar file
+def writeColumns(outputPath, columns, labels):
+    count = len(columns[0][1]) if columns else 0
+    arrays = []
+    for name, column in columns:
+        column = np.ascontiguousarray(column)
+        # Store everything little-endian so the layout doesn't depend on the machine
+        arrays.append((name, column.astype(column.dtype.newbyteorder("<"), copy=False)))
+
+    # The header holds the offsets of the columns, which depend on the header length.
+    # Size the header with oversized offsets first, then lay out the columns after it.
+    def layout(dataStart):
+        descriptions = []
+        offset = dataStart
+        for name, column in arrays:
+            descriptions.append({
+                "name": name,
+                "dtype": column.dtype.str,
+                "shape": list(column.shape),
+                "offset": offset,
+            })
+            offset = align(offset + column.nbytes)
+        return descriptions
+
+    header = {"version": binaryVersion, "count": count, "columns": layout(10**15), "labels": labels}
+    headerLength = align(binaryPreamble.size + len(json.dumps(header).encode("utf-8"))) - binaryPreamble.size
+    header["columns"] = layout(binaryPreamble.size + headerLength)
+    headerBytes = json.dumps(header).encode("utf-8").ljust(headerLength, b" ")
+
+    # Written to a temporary file and renamed into place, like the JSON document
+    temp = temporaryPath(outputPath)
+    try:
+        with open(temp, 'wb') as outputfile:
+            outputfile.write(binaryPreamble.pack(binaryMagic, binaryVersion, headerLength, 0))
+            outputfile.write(headerBytes)
+            for (name, column), description in zip(arrays, header["columns"]):
+                outputfile.write(b"\0" * (description["offset"] - outputfile.tell()))
+                outputfile.write(column.tobytes())
+        os.replace(temp, outputPath)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def align(offset):
+    return (offset + binaryAlignment - 1) // binaryAlignment * binaryAlignment
+
+# Memory-map a binary columnar file. Returns the header and a dict of read-only arrays.
+def loadBinary(path):
+    with open(path, 'rb') as inputfile:
+        magic, version, headerLength, _ = binaryPreamble.unpack(inputfile.read(binaryPreamble.size))
+        if magic != binaryMagic:
+            raise ValueError("%s is not a binary PDB export" % path)
+        if version > binaryVersion:
+            raise ValueError("%s has unsupported version %d" % (path, version))
+        header = json.loads(inputfile.read(headerLength).decode("utf-8"))
+
+    columns = {}
+    for description in header["columns"]:
+        shape = tuple(description["shape"])
+        if 0 in shape:
+            columns[description["name"]] = np.empty(shape, dtype=description["dtype"])
         else:
-            JSstruct = 2 # 2 for loops
-
-        # Set the category
-        curAA = RGroupAAs[i]
-        JScat = aaCategories[curAA]
-
-        # Set the asym value
-        JSasym = RGroupAsyms[i]
-
-        # Set the entity
-        JSentity = RGroupEntities[i]
-
-        # Append data to JSON
-        jsonData["entries"].append({
-            "site": JSsiteNum,
-            "asym": JSasym,
-            "entity": JSentity,
-            "structType": JSstruct,
-            "category": JScat
-        })
-    
-    # Open text file and dump json data to file
-    with open('data.txt', 'w') as outputfile:
-        json.dump(jsonData, outputfile)
+            columns[description["name"]] = np.memmap(path, dtype=description["dtype"],
+                    mode='r', offset=description["offset"], shape=shape)
+    return header, columns
+
+#################################################################################
+# Write the same data as pushJSON (plus B factor and residue number) to a binary file
+def pushBinary(structure, outputPath='data.bin', coordinates=False, contactParams=False):
+    atoms, structIndex = structure.atoms, structure.structIndex
+    if (coordinates or contactParams) and not atoms.hasCoordinates():
+        raise ValueError("the structure was parsed without coordinates")
+    with profiling.stage("classify atoms"):
+        structTypes = atoms.structTypes(structIndex)
+        categories = atoms.mapResidues(aaCategories, dtype=np.int8)
+
+    columns = [
+        ("site", atoms.site),
+        ("asym", atoms.asymCodes),
+        ("entity", atoms.entity),
+        ("seqId", atoms.seqId),
+        ("structType", structTypes),
+        ("category", categories),
+        ("bfactor", atoms.bfactor),
+    ]
+    # For a table aggregated by residue bfactor is the mean and coords the centroid
+    if isinstance(atoms, atomtable.ResidueTable):
+        columns.append(("atomCount", atoms.atomCount))
+        columns.append(("maxBfactor", atoms.maxBfactor))
+    if coordinates:
+        columns.append(("coords", atoms.coords))
+    if contactParams:
+        with profiling.stage("contacts"):
+            density, contactCounts = contacts.contactColumns(atoms)
+        columns.append(("density", density))
+        columns.append(("contacts", contactCounts))
+    labels = {"asym": list(atoms.asyms)}
+
+    # The HETATM table, if any, with its own labels
+    hetatms = structure.hetatms
+    if hetatms is not None:
+        columns.extend([
+            ("hetatm.site", hetatms.site),
+            ("hetatm.asym", hetatms.asymCodes),
+            ("hetatm.entity", hetatms.entity),
+            ("hetatm.residue", hetatms.residueCodes),
+            ("hetatm.atom", hetatms.atomCodes),
+            ("hetatm.bfactor", hetatms.bfactor),
+        ])
+        if coordinates:
+            columns.append(("hetatm.coords", hetatms.coords))
+        labels["hetatm.asym"] = list(hetatms.asyms)
+        labels["hetatm.residue"] = list(hetatms.residues)
+        labels["hetatm.atom"] = list(hetatms.atomNames)
+    with profiling.stage("write binary"):
+        writeColumns(outputPath, columns, labels)
 
 #################################################################################      
 
+# Output file extension for each export format
+exportExtensions = {"json": ".json", "binary": ".bin"}
+
+#################################################################################
+# INCREMENTAL EXPORT ############################################################
+# A batch export keeps a manifest in the output directory with the source path and a
+# digest of the inputs of every file it wrote: the parsed structure (its parse cache key,
+# which covers the file content and the parse options), aaCategories and the export
+# options. A file whose source and digest haven't changed is skipped. Otherwise it is exported again from the parse cache,
+# so changing aaCategories or an export option only costs the vectorized remap and the
+# writing, not a reparse.
+
+# Version of the exported files. Bump whenever a change to the export changes the files
+# written for the same inputs, so that they are all written again.
+exportVersion = 1
+
+# Name of the manifest in the output directory, and of the directory next to it holding
+# the parsed structures of the exported files
+manifestName = "manifest.json"
+parsedName = ".parsed"
+
+# Manifests already read by this process (each batch worker reads it once):
+# path -> (modification time, outputs)
+manifests = {}
+
+# Outcome of converting one file in batch mode: the output path, the digest of its inputs,
+# whether it was skipped because it was up to date and the key of its parsed structure
+Export = namedtuple("Export", ["path", "inputs", "skipped", "parseKey"])
+
+# Digest of the inputs of one export
+def exportInputs(parseKey, options):
+    settings = {
+        "exportVersion": exportVersion,
+        "aaCategories": aaCategories,
+        "options": options,
+    }
+    if options["contactParams"]:
+        settings["contactRadii"] = [contacts.densityRadius, contacts.contactRadius]
+    digest = hashlib.sha256(parseKey.encode("ascii"))
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+# Outputs recorded in the manifest of an output directory ({} when there is none)
+def loadManifest(outputDir):
+    path = os.path.join(outputDir, manifestName)
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    cached = manifests.get(path)
+    if cached is None or cached[0] != modified:
+        try:
+            with open(path, 'r') as file:
+                outputs = json.load(file)["outputs"]
+        except (OSError, ValueError, KeyError):
+            outputs = {}
+        cached = manifests[path] = (modified, outputs)
+    return cached[1]
+
+# Record the files exported by a batch in the manifest, and forget the outputs of the
+# files that failed (failed holds their output paths) so that they are exported again. It
+# is written to a temporary file and renamed into place so an interrupted run never leaves
+# a half written manifest. The parsed structures no output refers to any more are removed.
+def storeManifest(outputDir, sources, exports, failed=()):
+    outputs = dict(loadManifest(outputDir))
+    for source, export in zip(sources, exports):
+        outputs[os.path.basename(export.path)] = {"source": source, "inputs": export.inputs,
+                "parsed": export.parseKey}
+    for outputPath in failed:
+        outputs.pop(os.path.basename(outputPath), None)
+    handle, temp = tempfile.mkstemp(prefix=".tmp-", dir=outputDir)
+    with os.fdopen(handle, 'w') as file:
+        json.dump({"exportVersion": exportVersion, "outputs": outputs}, file, indent=1, sort_keys=True)
+    os.replace(temp, os.path.join(outputDir, manifestName))
+    parsecache.prune(os.path.join(outputDir, parsedName),
+            set(output.get("parsed") for output in outputs.values()))
+
+# Path of the file exported from path: its name without the input extension, in outputDir
+def outputFile(path, outputDir, exportFormat="json", compress=False):
+    stem = os.path.basename(path)
+    for extension in batch.extensions:
+        if stem.lower().endswith(extension):
+            stem = stem[:-len(extension)]
+            break
+    outputPath = os.path.join(outputDir, stem + exportExtensions[exportFormat])
+    if exportFormat == "json" and compress:
+        outputPath += ".gz"
+    return outputPath
+
+# Inputs that would be exported to the same file (e.g. x/1abc.cif and y/1abc.cif, or
+# 1abc.cif and 1abc.pdb): output path -> inputs, for the outputs with more than one
+def outputCollisions(paths, outputDir, exportFormat="json", compress=False):
+    inputs = {}
+    for path in paths:
+        inputs.setdefault(outputFile(path, outputDir, exportFormat, compress), []).append(path)
+    return dict((output, names) for output, names in inputs.items() if len(names) > 1)
+
+#################################################################################
+# Parse one file and export it. Used as the batch worker, so it takes no global state.
+# The file is skipped when its output is up to date with the manifest (unless force is
+# set) and read through the parsed structures kept in outputDir (see parsedName) unless
+# useCache is False. Returns an Export.
+def convertFile(path, outputDir, exportFormat="json", compress=False, coordinates=False,
+        contactParams=False, residues=False, model=1, ligands=False, waters=False, mapped=False,
+        useCache=True, force=False):
+    outputPath = outputFile(path, outputDir, exportFormat, compress)
+
+    # The contact parameters are computed from the coordinates
+    parseCoordinates = coordinates or contactParams
+    with profiling.stage("cache lookup"):
+        parseKey = parsecache.structureKey(path, coordinates=parseCoordinates, model=model,
+                ligands=ligands, waters=waters)
+    options = {"format": exportFormat, "compress": compress, "coordinates": coordinates,
+            "contactParams": contactParams, "residues": residues, "model": model,
+            "ligands": ligands, "waters": waters}
+    inputs = exportInputs(parseKey, options)
+    # Up to date when the output was written from this very file with the same inputs.
+    # Outputs are only ever renamed into place once complete, so an existing one is whole.
+    recorded = loadManifest(outputDir).get(os.path.basename(outputPath), {})
+    if not force and recorded.get("inputs") == inputs and \
+            recorded.get("source") == os.path.abspath(path) and os.path.exists(outputPath):
+        return Export(outputPath, inputs, True, parseKey)
+
+    if useCache:
+        structure = parsecache.readStructure(path, coordinates=parseCoordinates, model=model,
+                ligands=ligands, waters=waters, mapped=mapped, key=parseKey,
+                directory=os.path.join(outputDir, parsedName))
+    else:
+        structure = openFile(path, parseCoordinates, model, ligands, waters, mapped)
+    if len(structure.atoms) == 0:
+        raise ValueError("no side chain ATOM records found")
+    if residues:
+        structure = atomtable.residueStructure(structure)
+    if exportFormat == "binary":
+        pushBinary(structure, outputPath, coordinates, contactParams)
+    else:
+        pushJSON(structure, outputPath, compress, coordinates, contactParams)
+    return Export(outputPath, inputs, False, parseKey)
+
+#################################################################################
 # Main Loop
 def main():
-    pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
-    openFile(pdbFile)
-    pushJSON()
-    print("JSON file created.")
+    parser = argparse.ArgumentParser(description="Write PDB side chain data to JSON for Unity.")
+    batch.addArguments(parser)
+    parser.add_argument("-o", "--output-dir", default=".",
+            help="directory for the exported files in batch mode (default: current directory)")
+    parser.add_argument("-f", "--format", choices=sorted(exportExtensions), default="json",
+            help="export format (default: json)")
+    parser.add_argument("-z", "--gzip", action="store_true", help="gzip the JSON output")
+    parser.add_argument("-c", "--coords", action="store_true",
+            help="export the atom coordinates (x, y, z) as well")
+    parser.add_argument("--contacts", action="store_true",
+            help="export the packing density and residue contacts of each atom as well")
+    parser.add_argument("-r", "--residues", action="store_true",
+            help="export one entry per residue (atom count, mean/max B factor) instead of per atom")
+    parser.add_argument("--ligands", action="store_true",
+            help="export the HETATM atoms of ligands to a separate \"ligands\" list / hetatm columns")
+    parser.add_argument("--waters", action="store_true", help="export the water HETATM atoms as well")
+    parser.add_argument("--mmap", action="store_true",
+            help="parse mmCIF files from a memory map, which needs far less memory for large files")
+    parser.add_argument("--force", action="store_true",
+            help="in batch mode, export every file even when the manifest says it is up to date")
+    parser.add_argument("--no-cache", action="store_true",
+            help="in batch mode, always reparse the files instead of using the parsed structures kept with the output")
+    batch.addModelArgument(parser)
+    profiling.addArguments(parser)
+    args = parser.parse_args()
+    # Profiling is collected in this process, so don't fan out to workers
+    if profiling.setup(args):
+        args.workers = 1
+    try:
+        convert(args)
+    finally:
+        profiling.finish(args.profile)
+
+def convert(args):
+    # Interactive mode for a single file
+    if not args.paths:
+        pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
+        # -f/--format is the default answer
+        exportFormat = input("\nExport format, 'json' or 'binary' (press 'Enter' for %s): \n\n"
+                % args.format).strip() or args.format
+        structure = openFile(pdbFile, args.coords or args.contacts, args.model, args.ligands, args.waters,
+                args.mmap)
+        if args.residues:
+            structure = atomtable.residueStructure(structure)
+        if exportFormat == "binary":
+            pushBinary(structure, coordinates=args.coords, contactParams=args.contacts)
+            print("Binary file created.")
+        else:
+            outputPath = "data.txt.gz" if args.gzip else "data.txt"
+            pushJSON(structure, outputPath, args.gzip, coordinates=args.coords, contactParams=args.contacts)
+            print("JSON file created.")
+        return
+
+    # Batch mode
+    paths = batch.expandPaths(args.paths)
+    # One output file per input: stop before writing anything when two would share a name
+    collisions = outputCollisions(paths, args.output_dir, args.format, args.gzip)
+    if collisions:
+        for output, names in sorted(collisions.items()):
+            print("%s would be written by %s" % (output, ", ".join(names)), file=sys.stderr)
+        sys.exit("Some inputs have the same name; convert them to separate output directories.")
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = batch.runBatch(convertFile, paths, (args.output_dir, args.format, args.gzip, args.coords,
+            args.contacts, args.residues, args.model, args.ligands, args.waters, args.mmap,
+            not args.no_cache, args.force), args.workers)
+
+    # Record what was exported, so the next run only redoes the files whose inputs change
+    done = [result for result in results if result.error is None]
+    failed = [outputFile(result.path, args.output_dir, args.format, args.gzip)
+            for result in results if result.error is not None]
+    storeManifest(args.output_dir, [os.path.abspath(result.path) for result in done],
+            [result.value for result in done], failed)
+    skipped = sum(1 for result in done if result.value.skipped)
+    print("%d exported, %d up to date" % (len(done) - skipped, skipped))
+    if len(done) < len(results):
+        sys.exit(1)
     
 if __name__ == '__main__': main()
@@ -10,88 +10,69 @@ of data from protein backbone data as well.
 NOTE: When porting to C# for Unity, all references to OSC should be scrubbed. All variables
 and the importing of data should be made internal to C# and Unity with no calls over UDP.
 
+Ticks are timed by a drift-free scheduler (scheduler.py) and stamped with future OSC 
+timetags. Type a new speed while playing to change the tempo; pass --sleep for the old 
+sleep-after-each-tick timing. Pass several files to play them together on the asyncio 
+engine (oscengine.py), each under its own address prefix (/s1, /s2, ...). Pass --contacts
+to also send the packing density (/density) and residue contacts (/contacts), see contacts.py.
+Pass --residues to play one tick per residue instead of one per atom. Pass --ligands to
+read the ligands too and send /ligand with the ligand's name whenever playback reaches a
+residue bound to one.
+
 Brian Cantrell, Worldbuilding Media Lab. Sept, 2020.
 Updated Oct. 2020.
 """
-from pythonosc import osc_message_builder
-from pythonosc import osc_bundle_builder
 from pythonosc import udp_client
-import os
+import sys
+import socket
 import time
-import json
+import argparse
+import threading
+import asyncio
+import parsecache
+import atomtable
+import batch
+import scheduler
+import oscengine
+import telemetry
 
 #################################################################################
 # OSC SETUP #####################################################################
 port = 5005
 ip = "127.0.0.1"
 client = udp_client.SimpleUDPClient(ip, port)
-BFactorMsg = 0
-hydroMsg = 0
+# Socket for sending encoded bundles
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# Pack all of a tick's messages into one timestamped OSC bundle (one UDP packet per tick).
+# Set to False to send each message as its own packet.
+useBundles = True
+# Encode every bundle of the loop once at load time and only patch the timetag while 
+# playing (oscengine.PacketCache). Uses more memory for very large structures.
+usePacketCache = False
+# Also send the local packing density of every atom (/density) and the residue contacts
+# of each new chain (/contacts)
+useContacts = False
+# Play one tick per residue with its mean B factor (/BFactor), highest B factor (/maxBFactor)
+# and number of atoms (/atomCount), instead of one tick per atom
+useResidues = False
+# Read the ligands too and send the name of the ligand bound to each residue reached (/ligand)
+useLigands = False
+# Model of multi-model files (e.g. NMR ensembles) to play, None for all of them
+model = 1
 
 # TODO: test to see if boolean values work with PD
-# TODO: Get rid of global variables and make script OO with get methods 
-
-newAsymMsg = False
-newEntityMsg = False
-newAAMsg = False
-structTypeMsg = 5 # Initialize a value higher than the one used for message (0,1,2)
-categoryMsg = 8 # Initialize a value higher than the one used for message (0,1,2,3,4)
-iteratorMsg = 0
 
 #################################################################################
 #GLOBAL VARIABLES ###############################################################
-# Column indices (WARNING: THESE MIGHT CHANGE ACCORDING TO FILE TYPE)
-BFactorCol = 14 #Column for temperature (B Factor)
-atomCol = 3 # Column for atom name
-AACol = 5 # Column for amino acid label
-chainCol = 8 # Column for the chain number
-asymCol = 6 # Column for the asymmetry chain letter
-entityCol = 7 # Column for the entity number
-beginHelix = 5 # Column number for the start of the helix (gives amino acid number)
-endHelix = 9 # Column number for the end of the helix (gives amino acid number)
-beginSheet = 4 # Column number for the beginning AA of the sheet
-endSheet = 8 # Column number for the ending AA of the sheet
-
-# Lists to hold the relevant data
-RGroupAAs = [] # List to hold R Group amino acids (used to index hydroVals)
-RGroupChains = [] # List to hold R Group chain numbers (corresponding to amino acid)
-RGroupBFactors = [] # List to hold R Group B factors
-RGroupAsyms = [] # List to hold R Group asym values
-RGroupEntities = [] # List to hold R Group entity values
-helices = [] # List to hold helices for structType
-sheets = [] # List to hold sheets for structType
-loops = [] # List to hold loops for structType
+# The loaded structure with its own cursor and "new asym/entity/chain" state 
+# (oscengine.Stream). Several structures can be played at once with oscengine.Engine.
+stream = None
 
-# Variables to hold temp values
-newAsymVal = ' '
-oldAsymVal = ' '
-newEntityVal = 0
-oldEntityVal = 20000 # Set oldEntityVal to something high to prevent false positives
-newAAVal = ' '
-oldAAVal = ' '
-newChainVal = 0
-oldChainVal = 20000 # Set high to prevent false positives
-newHydroVal = 0
-oldHydroVal = 2000
-
-# Booleans for "new AA," "new asym," and "new entity" messages
-newAA = True
-newAsym = True
-newEntity = True
-newChain = True
-oldAA = False
-oldAsym = False
-oldEntity = False
-oldChain = False
-newHydro = True
-oldHydro = False
-# Boolean for determining whether the next entries are sheet structures
-isSheet = False
+# Tick counters and status output (telemetry.Telemetry)
+stats = telemetry.Telemetry()
 
 PDBFile = " " # Hold the selected file
 speed = .4 # Global speed for the OSC engine
- # Create an iterator to use for timing
-iterator = 0
 
 # Dictionary of hydrophobicity values
 hydroVals = { 
@@ -145,223 +126,169 @@ aaCategories = {
 #################################################################################
 # Open a file
 def openFile(data):
-    file = open(data, 'r')
-
     # make global variables visible
-    
-    global RGroupAAs
-    global RGroupBFactors
-    global RGroupAsyms
-    global RGroupEntities
-    global RGroupChains
-    global helices
-    global beginHelix
-    global endHelix
-
-    global isSheet
-    # Clear lists just in case...
-    RGroupAAs.clear()
-    RGroupBFactors.clear()
-    RGroupAsyms.clear()
-    RGroupEntities.clear()
-    RGroupChains.clear()
-    
-    if file is not None:
-        # Split the file up by line
-        theFile = file.readlines()
-         # Loop over file and select for ATOM entries
-        for line in theFile:
-            entry = line.split()
-
-            # Here is where we determine whether the current amino acid is part of a helix, loop, or sheet
-            # Check for helix entry first
-            if entry[0] == "HELX_P":
-                firstHAA = int(entry[beginHelix])
-                lastHAA = int(entry[endHelix])
-                # Push the first and last AA number and every number between into helices list
-                for i in range(firstHAA, lastHAA+1):
-                    helices.append(i)
-
-            # Fill sheets list
-            if entry[0] == "_struct_sheet_range.end_auth_seq_id":
-                # Assign boolean to get sheet values until "#" is reached.
-                isSheet = True
-            
-            if isSheet == True and entry[0] != "_struct_sheet_range.end_auth_seq_id" and entry[0] != "#":
-            
-                firstSAA = int(entry[beginSheet])
-                lastSAA = int(entry[endSheet])
-                for i in range(firstSAA, lastSAA+1):
-                    sheets.append(i)
-            elif entry[0] == "#":
-                isSheet = False
-
-            
-            # Move on to atomic coordinates for rest of data
-            # Select for only those lines listing ATOM coordinates
-            if entry[0] == "ATOM":
-                # Ignore the lines with backbone entries
-                atomName = str(entry[atomCol])
-                atomName.strip()
+    global stream
 
-                if atomName == "CA" or atomName == "C" or atomName == "N" or atomName == "O" or atomName == "CB":
-                    pass
-                # Push R Group amino acid labels and B Factor values to lists
-                else:
-                    #print(atomName)
-                    RGroupAAs.append(entry[AACol])
-                    RGroupBFactors.append(entry[BFactorCol])
-                    RGroupAsyms.append(entry[asymCol])
-                    RGroupEntities.append(entry[entityCol])
-                    RGroupChains.append(entry[chainCol])
+    # Stream the helix, sheet and ATOM records from the file. The backbone entries are
+    # skipped and the R Group atoms go into a columnar table.
+    # Here is where we determine whether the current amino acid is part of a helix, loop, or sheet:
+    # every helix and sheet residue goes into the structure index.
+    # Files that were parsed before are loaded from the parse cache instead.
+    structure = parsecache.readStructure(data, model=model, ligands=useLigands)
+    if useResidues:
+        structure = atomtable.residueStructure(structure)
+    stream = oscengine.Stream(structure, hydroVals, aaCategories, useContacts=useContacts,
+            useLigands=useLigands)
+    if usePacketCache:
+        stream.cachePackets()
+    return structure.atoms
         
-    else:
-        print("file is none")
-    
 #################################################################################
 # Start the OSC engine
-def runOSC():
-    global iterator
-    global newAsymVal
-    global oldAsymVal
-    global newEntityVal
-    global oldEntityVal
-    global newChainVal
-    global oldChainVal
-    global newAAVal
-    global oldAAVal
-    global newHydroVal
-    global oldHydroVal
+# When timetag is given (seconds since the epoch) the bundle is stamped with it and the
+# caller handles the timing; otherwise the tick ends by sleeping for `speed`.
+# lateness is how far behind schedule the caller is sending this tick.
+def runOSC(timetag=None, lateness=0.0):
+    start = time.perf_counter()
+    # B Factor, hydrophobicity and (when they change) new asym, new entity and new chain
+    # with its category and structure type
+    if useBundles:
+        # Send all of the tick's messages together, stamped with their play time
+        sock.sendto(stream.nextDatagram(time.time() if timetag is None else timetag), (ip, port))
+    else:
+        for address, value in stream.nextMessages():
+            client.send_message(address, value)
 
-    global newAsym
-    global newEntity
-    global newChain
-    global newAA
-    global newHydro
+    # Count the tick. Status lines are written by a background thread (see telemetry.py)
+    stats.tick(time.perf_counter() - start, lateness, stream.status)
+    # Sleep to control speed (the scheduler handles timing when a timetag is given)
+    if timetag is None:
+        time.sleep(speed)
 
-    global BFactorMsg
-    global hydroMsg
-    global structTypeMsg
-    global categoryMsg
+#################################################################################
+# Change the tempo while playing: read new speeds (seconds per tick) typed on stdin
+def listenForTempo(schedulers):
+    global speed
+    for line in sys.stdin:
+        try:
+            newSpeed = float(line)
+            for ticks in schedulers:
+                ticks.setPeriod(newSpeed)
+        except ValueError:
+            print("Type a speed in seconds per tick (e.g. 0.25) and press 'Enter'.")
+            continue
+        speed = newSpeed
+        print("Speed set to %g seconds per tick." % speed)
 
-    # Set B Factor message
-    BFactorMsg = RGroupBFactors[iterator]
-    client.send_message("/BFactor", float(BFactorMsg))
-    
-    # Retrieve hydrophobicity from table by indexing the amino acids list
-    aminoAcid = RGroupAAs[iterator]
-    
-    # Set hydrophobicity message DO NOT DELETE
-    hydroMsg = hydroVals[aminoAcid]
-    client.send_message("/hydrophobicity", hydroMsg)
-    # Set new asym message
-    # Check if new asym is same as old asym
-    newAsymVal = RGroupAsyms[iterator]
-    newEntityVal = RGroupEntities[iterator]
-    
-    #newHydroVal = hydroVals[aminoAcid] DO NOT DELETE
-    #newAA = RGroupAAs[iterator]
-    
-    newChainVal = RGroupChains[iterator]
-    
-    """ DO NOT DELETE
-    # New hydrophobicity logic
-    if newHydroVal != oldHydroVal:
-        newHydro = True
-        client.send_message("/hydrophobicity", hydroMsg)
-        oldHydroVal = newHydroVal
-        newHydro = False
-    else:
-        pass
-    """
+# Play on a drift-free schedule. Each tick is sent `latency` seconds ahead with a future
+# timetag so the receiver can play it exactly on time.
+def runScheduled(latency):
+    ticks = scheduler.Scheduler(speed, latency)
+    tempoThread = threading.Thread(target=listenForTempo, args=([ticks],), daemon=True)
+    tempoThread.start()
 
-    # New asym logic
-    if newAsymVal != oldAsymVal:
-        newAsym = True
-        client.send_message("/newAsym", newAsym)
-        oldAsymVal = newAsymVal
-        newAsym = False
-    else:
-        pass
-    
-    # New entity logic
-    if newEntityVal != oldEntityVal:
-        newEntity = True
-        client.send_message("/newEntity", newEntity)
-        oldEntityVal = newEntityVal
-        newEntity = False
-    else:
-        pass
-    
-    # Redundancy with newChain
-    '''
-    # New AA logic
-    if newAAVal != oldAAVal:
-        newAA = True
-        client.send_message("/newAA", newAA)
-        oldAAVal = newAAVal 
-        newAA = False
-    else:
-        pass
-    '''
+    while True:
+        deadline = ticks.wait()
+        runOSC(ticks.timetag(deadline), ticks.lastLateness)
 
-    # New chain number logic. 
-    # In this conditional, we check to see if we are in a new chain and get its structure type
-    # Then send both over OSC
+# Play several structures at once on the asyncio engine. Stream n sends its messages
+# under /s<n> (e.g. /s1/BFactor) so they can be told apart.
+def runEngine(paths, latency):
+    streamStats = {}
+    def countTick(tickStream, ticks, duration):
+        streamStats[tickStream.name].tick(duration, ticks.lastLateness, tickStream.status)
 
-    if newChainVal != oldChainVal:
-        newChain = True
-        client.send_message("/newChain", newChain)    
-        
-        # Retrieve category type and assign to category message
-        categoryMsg = aaCategories[aminoAcid]
-        client.send_message("/category", categoryMsg)
-        
-        # Get structure type of the chain (0 = helix, 1 = sheet, 2 = loop) and set struct message.
-        ncv = int(newChainVal)
-        if (ncv in helices):
-            structTypeMsg = 0
-        elif (ncv in sheets):
-            structTypeMsg = 1
-        else:
-            structTypeMsg = 2
-        client.send_message("/structType", structTypeMsg)
-        
-        # Set new chain to old chain to check for next new chain.
-        oldChainVal = newChainVal
-        newChain = False
-    else:
-        pass
-    
-    # Set Hydrophibicity messages
-    print("Category: ", categoryMsg, " ", "Structure Type: ", structTypeMsg, " ", "Asym: ", 
-            newAsymVal, " ", "Entity: ", newEntityVal, " ", "Chain: ", newChainVal, "\n")
-    # Increment iterator    
-    iterator += 1
-    # Take modulus to loop back to beginning of lists
-    iterator %= len(RGroupAAs)
-    # Sleep to control speed
-    time.sleep(speed)
+    engine = oscengine.Engine(ip, port, latency, onTick=countTick)
+    schedulers = []
+    for n, path in enumerate(paths, 1):
+        structure = parsecache.readStructure(path, model=model, ligands=useLigands)
+        if useResidues:
+            structure = atomtable.residueStructure(structure)
+        prefix = "/s%d" % n
+        playStream = oscengine.Stream(structure, hydroVals, aaCategories, name=prefix, prefix=prefix,
+                useContacts=useContacts, useLigands=useLigands)
+        if usePacketCache:
+            playStream.cachePackets()
+        schedulers.append(engine.add(playStream, speed))
+        streamStats[prefix] = telemetry.Telemetry(prefix, stats.interval)
+        print("%s: %s" % (prefix, path))
+
+    tempoThread = threading.Thread(target=listenForTempo, args=(schedulers,), daemon=True)
+    tempoThread.start()
+    try:
+        asyncio.run(engine.run())
+    finally:
+        for streamTelemetry in streamStats.values():
+            streamTelemetry.summary()
 
 #################################################################################
 # Main Loop
 def main():
-    pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
-    openFile(pdbFile)
-    
-    """
-    # Debug sheets and helices lists
-    print("Sheets: \n")
-    for i in sheets:
-        print(i)
-    print("Helices: \n")
-    for i in helices:
-        print(i)
-    """
-  
-    # TODO: Implement better quit code
+    global speed
+    global usePacketCache
+    global useContacts
+    global useResidues
+    global useLigands
+    global model
+    global stats
+    parser = argparse.ArgumentParser(description="Sonify the R Groups of PDB files over OSC.")
+    parser.add_argument("paths", nargs="*",
+            help="mmCIF file(s), played together when more than one (prompts for one when omitted)")
+    parser.add_argument("-s", "--speed", type=float, default=speed,
+            help="seconds per tick (default: %(default)s). Type a new value while playing to change it.")
+    parser.add_argument("-l", "--latency", type=float, default=0.05,
+            help="seconds each bundle is sent ahead of its timetag (default: %(default)s)")
+    parser.add_argument("--sleep", action="store_true",
+            help="time ticks by sleeping after each one instead of using the scheduler")
+    parser.add_argument("--packet-cache", action="store_true",
+            help="encode all OSC bundles once at load time instead of on every tick")
+    parser.add_argument("--contacts", action="store_true",
+            help="also send the packing density (/density) and residue contacts (/contacts)")
+    parser.add_argument("--residues", action="store_true",
+            help="play one tick per residue (mean/max B factor, atom count) instead of per atom")
+    parser.add_argument("--ligands", action="store_true",
+            help="also send the name of the ligand bound to each residue reached (/ligand)")
+    batch.addModelArgument(parser)
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+            help="DEBUG: status line every tick, INFO: rate-limited status line (default), "
+                 "WARNING: late ticks only")
+    parser.add_argument("--status-interval", type=float, default=1.0,
+            help="seconds between status lines at INFO level (default: %(default)s)")
+    args = parser.parse_args()
+    speed = args.speed
+    usePacketCache = args.packet_cache
+    useContacts = args.contacts
+    useResidues = args.residues
+    useLigands = args.ligands
+    model = args.model
+    telemetry.setup(args.log_level)
+    stats = telemetry.Telemetry(interval=args.status_interval)
+
     print("Press ctrl+c to quit.")
-    while True:
-        runOSC()
+    try:
+        if len(args.paths) > 1:
+            runEngine(args.paths, args.latency)
+            return
+
+        pdbFile = args.paths[0] if args.paths else None
+        if pdbFile is None:
+            pdbFile = input("\nPlease enter the path/name of the .cif or .pdb file and press 'Enter': \n\n")
+        openFile(pdbFile)
+        
+        """
+        # Debug structure index
+        print("Structure index: \n")
+        for (asym, seq), structType in sorted(stream.structIndex.items()):
+            print(asym, seq, structType)
+        """
+    
+        if args.sleep:
+            while True:
+                runOSC()
+        else:
+            runScheduled(args.latency)
+    except KeyboardInterrupt:
+        if stats.ticks:
+            stats.summary()
       
 if __name__ == '__main__': main()
@@ -0,0 +1,175 @@
+"""
+Streaming reader for legacy fixed-width PDB files (.pdb, .ent).
+
+In the PDB format every field sits at fixed columns and neighbouring fields can run
+together (e.g. large coordinates or long residue numbers), so the lines can't be split on
+white space. The fields are sliced straight out of each line instead.
+
+readRecords() yields the same cifreader.Record tuples as the mmCIF reader, with the fields
+in the order of cifreader.ATOM_FIELDS and RANGE_FIELDS, so atomtable builds the same
+Structure from either format. HELIX and SHEET records give the helix and sheet ranges.
+The entity of each chain comes from the MOL_ID/CHAIN specifications of the COMPND records
+(1 when there are none). Chains, residue numbers and ranges use the author numbering of
+the PDB file, except for insertion codes (column 27, e.g. 82, 82A, 82B in Kabat
+numbering): from the first inserted residue of a chain on, the residues are numbered in
+file order like label_seq_id (82, 83, 84, then 85 for author 83), so every residue keeps
+its own number. The HELIX and SHEET ranges, with their insertion codes, are numbered the
+same way; they are yielded after the atoms since they name residues read later.
+
+isLegacyPDB() tells the two formats apart by looking at the start of a file.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+from cifreader import Record, ATOM, HETATM, HELIX, SHEET, ALL_KINDS
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+# Record names that can start a legacy PDB file
+pdbRecords = ("HEADER", "OBSLTE", "TITLE ", "SPLIT ", "CAVEAT", "COMPND", "SOURCE", "KEYWDS",
+        "EXPDTA", "NUMMDL", "MDLTYP", "AUTHOR", "REVDAT", "SPRSDE", "JRNL  ", "REMARK",
+        "DBREF ", "SEQRES", "HELIX ", "SHEET ", "CRYST1", "ORIGX1", "SCALE1", "MODEL ",
+        "ATOM  ", "HETATM")
+
+# Number of lines looked at to recognise the format
+sniffLines = 64
+
+#################################################################################
+# True when the file is a legacy PDB file rather than mmCIF
+def isLegacyPDB(path):
+    with open(path, 'r') as file:
+        for n, line in enumerate(file):
+            if n >= sniffLines:
+                break
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line.startswith(("data_", "loop_", "_")):
+                return False
+            if line[:6].upper().ljust(6) in pdbRecords:
+                return True
+    return False
+
+# Decode a hybrid-36 atom serial number. Files with more than 99999 atoms write the serials
+# from 100000 on as A0000, A0001, ...
+def decodeSerial(serial):
+    serial = serial.strip()
+    if serial[0].isupper():
+        return str(int(serial, 36) - 10 * 36**4 + 10**5)
+    return str(int(serial, 36) + 16 * 36**4 + 10**5)
+
+# Map chain IDs to entity (MOL_ID) numbers from the text of the COMPND records
+def parseCompound(text):
+    entities = {}
+    molecule = "1"
+    for specification in text.split(";"):
+        key, _, value = specification.partition(":")
+        key = key.strip()
+        if key == "MOL_ID":
+            molecule = value.strip()
+        elif key == "CHAIN":
+            for chain in value.split(","):
+                entities[chain.strip()] = molecule
+    return entities
+
+#################################################################################
+# Number the residue (chain, residue number and insertion code, line[21:27] of an atom
+# record) the first time it is seen. numbers maps residues to numbers and shifts maps
+# chains to the count of inserted residues before it.
+def numberResidue(residue, numbers, shifts):
+    chain = residue[0]
+    shift = shifts.get(chain, 0)
+    if residue[5] != " ":
+        shift += 1
+        shifts[chain] = shift
+    number = residue[1:5] if shift == 0 else str(int(residue[1:5]) + shift)
+    numbers[residue] = number
+    return number
+
+# Number of the residue of a helix or sheet range (same form as in numberResidue). A
+# residue without atoms takes the shift of the last residue of its chain before it.
+def rangeNumber(residue, numbers):
+    number = numbers.get(residue)
+    if number is not None:
+        return number.strip()
+    chain, position = residue[0], (int(residue[1:5]), residue[5])
+    shift, closest = 0, None
+    for other, number in numbers.items():
+        if other[0] != chain:
+            continue
+        otherPosition = (int(other[1:5]), other[5])
+        if otherPosition <= position and (closest is None or otherPosition > closest):
+            closest = otherPosition
+            shift = int(number) - otherPosition[0]
+    return str(position[0] + shift)
+
+#################################################################################
+# Stream the records of a legacy PDB file. With model set (e.g. 1) only the ATOM and
+# HETATM records of that model are yielded; files without MODEL records hold model 1 only.
+def readRecords(path, kinds=ALL_KINDS, model=None):
+    wantAtoms = ATOM in kinds
+    wantHetatms = HETATM in kinds
+    wantHelices = HELIX in kinds
+    wantSheets = SHEET in kinds
+    wantRanges = wantHelices or wantSheets
+    if model is not None:
+        model = str(model)
+
+    compound = []           # Text of the COMPND records
+    entities = None         # Chain -> entity, parsed from compound at the first atom
+    inModel = model is None or model == "1"
+    numbers = {}            # Residue (line[21:27]) -> residue number, see numberResidue
+    shifts = {}             # Chain -> inserted residues so far
+    lastResidue = None
+    number = None
+    ranges = []             # (kind, first residue, last residue), numbered after the atoms
+
+    with open(path, 'r') as file:
+        for line in file:
+            # Hot path: atom records
+            isAtom = line.startswith("ATOM  ")
+            if isAtom or line.startswith("HETATM"):
+                wanted = inModel and (wantAtoms if isAtom else wantHetatms)
+                if not wanted and not wantRanges:
+                    continue
+                line = line.rstrip("\n").ljust(66)
+                residue = line[21:27]
+                if residue != lastResidue:
+                    number = numbers.get(residue)
+                    if number is None:
+                        number = numberResidue(residue, numbers, shifts)
+                    lastResidue = residue
+                if not wanted:
+                    continue
+                if entities is None:
+                    entities = parseCompound("".join(compound))
+                serial = line[6:11]
+                if line[6] > "9":
+                    serial = decodeSerial(serial)
+                chain = line[21].strip()
+                yield Record(ATOM if isAtom else HETATM, (
+                        serial,                 # Site number
+                        line[12:16].strip(),    # Atom name
+                        line[17:20].strip(),    # Residue name
+                        chain,                  # Chain
+                        entities.get(chain, "1"),
+                        number,                 # Residue number
+                        line[60:66],            # Temperature (B Factor)
+                        line[30:38],            # Coordinates
+                        line[38:46],
+                        line[46:54],
+                    ))
+                continue
+
+            if line.startswith("MODEL "):
+                inModel = model is None or line[6:].strip() == model
+            elif line.startswith("COMPND"):
+                compound.append(line[10:80].rstrip())
+            elif line.startswith("HELIX ") and wantHelices:
+                line = line.ljust(40)
+                ranges.append((HELIX, line[19] + line[21:26], line[31] + line[33:38]))
+            elif line.startswith("SHEET ") and wantSheets:
+                line = line.ljust(40)
+                ranges.append((SHEET, line[21] + line[22:27], line[32] + line[33:38]))
+
+    for kind, first, last in ranges:
+        yield Record(kind, (first[0].strip(), rangeNumber(first, numbers), last[0].strip(),
+                rangeNumber(last, numbers)))
@@ -0,0 +1,181 @@
+"""
+Opt-in profiling hooks for diagnosing slow conversions without editing the scripts.
+
+The parser and exporters mark their stages (reading and dispatching records, converting
+columns, secondary structure, classification, writing...) with stage() and
+timedIterator(). These cost nothing until profiling is enabled; then every stage collects
+its wall clock time and call count, and with traceMemory also the memory it allocated and
+kept, and its peak (tracemalloc). report() prints the table.
+
+For a single run a full cProfile capture and the top tracemalloc allocation sites can be
+added. pdb2json.py and PDB_parser.py expose all of this with:
+    --timings           per-stage summary
+    --trace-memory      per-stage allocation counters and the top allocation sites
+    --profile FILE      cProfile capture, saved to FILE (read it with pstats or snakeviz)
+Profiling runs in a single process, so batch mode uses one worker while it is on.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import cProfile
+import pstats
+import time
+import tracemalloc
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+enabled = False     # Collect stage statistics
+traceMemory = False # Also count allocations (tracemalloc)
+stages = {}         # Stage name -> StageStats, in the order the stages first ran
+startTime = None    # When profiling was enabled
+profiler = None     # cProfile.Profile of the current capture
+
+#################################################################################
+# Statistics of one stage
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocated = 0  # Bytes allocated and still held at the end of the stage
+        self.peak = 0       # Highest memory use above the start of the stage
+        self.traced = False # Whether the memory was traced (not for timedIterator stages)
+
+def stats(name):
+    stageStats = stages.get(name)
+    if stageStats is None:
+        stageStats = stages[name] = StageStats(name)
+    return stageStats
+
+# Times one run of a stage (the context manager returned by stage())
+class StageTimer(object):
+    def __init__(self, stageStats):
+        self.stats = stageStats
+
+    def __enter__(self):
+        if traceMemory:
+            self.memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.seconds += time.perf_counter() - self.start
+        self.stats.calls += 1
+        if traceMemory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.stats.allocated += current - self.memory
+            self.stats.peak = max(self.stats.peak, peak - self.memory)
+            self.stats.traced = True
+
+# Does nothing, returned by stage() while profiling is off
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+nullTimer = NullTimer()
+
+#################################################################################
+# Context manager timing the code inside it as the stage `name`, e.g.
+#     with profiling.stage("write JSON"):
+#         ...
+def stage(name):
+    if not enabled:
+        return nullTimer
+    return StageTimer(stats(name))
+
+# Wrap an iterable so the time spent producing its items is counted as the stage `name`.
+# Used for the record streams, where reading and dispatching the lines happens inside the
+# generator. Returns the iterable itself while profiling is off.
+def timedIterator(name, iterable):
+    if not enabled:
+        return iterable
+    return timedItems(stats(name), iter(iterable))
+
+def timedItems(stageStats, iterator):
+    clock = time.perf_counter
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stageStats.seconds += clock() - start
+            return
+        stageStats.seconds += clock() - start
+        stageStats.calls += 1
+        yield item
+
+#################################################################################
+# Turn profiling on (and optionally allocation tracing and a cProfile capture)
+def enable(memory=False, capture=False):
+    global enabled, traceMemory, startTime, profiler
+    enabled = True
+    traceMemory = memory
+    stages.clear()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if capture:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    startTime = time.perf_counter()
+
+# Turn profiling off and print the report. The cProfile capture, if any, is saved to
+# profilePath and its top functions are printed.
+def finish(profilePath=None, top=20):
+    global enabled, profiler
+    if not enabled:
+        return
+    if profiler is not None:
+        profiler.disable()
+    report()
+
+    if profiler is not None:
+        if profilePath:
+            profiler.dump_stats(profilePath)
+            print("\ncProfile capture saved to %s" % profilePath)
+        print("\nTop %d functions by cumulative time:" % top)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+        profiler = None
+
+    if traceMemory:
+        print("Top %d allocation sites still holding memory:" % top)
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:top]:
+            print("  %s" % statistic)
+        tracemalloc.stop()
+    enabled = False
+
+# Print the per-stage table
+def report():
+    wall = time.perf_counter() - startTime
+    print("\n%-28s %10s %10s %7s" % ("stage", "calls", "seconds", "share") +
+            ("  %12s %10s" % ("kept MB", "peak MB") if traceMemory else ""))
+    for stageStats in stages.values():
+        line = "%-28s %10d %10.4f %6.1f%%" % (stageStats.name, stageStats.calls, stageStats.seconds,
+                100.0 * stageStats.seconds / wall if wall else 0.0)
+        if stageStats.traced:
+            line += "  %12.2f %10.2f" % (stageStats.allocated / 1e6, stageStats.peak / 1e6)
+        print(line)
+
+    # Time outside of the stages (e.g. the loop filtering the records)
+    other = wall - sum(stageStats.seconds for stageStats in stages.values())
+    print("%-28s %10s %10.4f %6.1f%%" % ("(other)", "", other, 100.0 * other / wall if wall else 0.0))
+    print("%-28s %10s %10.4f" % ("wall clock", "", wall))
+
+#################################################################################
+# Command line options shared by the scripts
+def addArguments(parser):
+    parser.add_argument("--timings", action="store_true",
+            help="print the time spent in each stage of the run")
+    parser.add_argument("--trace-memory", action="store_true",
+            help="also count the memory allocated in each stage (slower) and list the top allocation sites")
+    parser.add_argument("--profile", metavar="FILE", default=None,
+            help="capture a cProfile of the run, save it to FILE and print the top functions")
+
+# Enable profiling as asked on the command line. Returns True when it is on.
+def setup(args):
+    if args.timings or args.trace_memory or args.profile:
+        enable(args.trace_memory, args.profile is not None)
+        return True
+    return False
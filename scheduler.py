@@ -0,0 +1,96 @@
+"""
+Drift-free tick scheduler for the sonification loop.
+
+Sleeping for a fixed time after each tick lets the time taken by the sends (and anything
+else in the loop) accumulate, so the tempo drifts. The Scheduler instead computes the
+absolute deadline of every tick against the monotonic clock, so a slow tick only delays
+itself and never the ticks after it.
+
+wait() sleeps the calling thread. The asyncio engine (oscengine.py) uses next(), delay()
+and sent() instead so it can await the delay on the event loop.
+
+Ticks can be sent ahead of time: with a latency set, wait() returns `latency` seconds
+before each deadline and timetag() gives the wall clock time of the deadline, so the OSC
+bundle can be stamped with a future timetag and played on time by the receiver.
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import threading
+import time
+
+#################################################################################
+class Scheduler(object):
+    def __init__(self, period, latency=0.0, lateThreshold=0.005):
+        self.period = period                # Seconds between ticks
+        self.latency = latency              # How far ahead of its deadline a tick is sent
+        self.lateThreshold = lateThreshold  # Seconds after its send time a tick counts as late
+        self.lock = threading.Lock()
+
+        # Deadlines are anchorTime + (tick - anchorTick) * period. The anchor moves on
+        # tempo changes so ticks already scheduled keep their timing.
+        self.tick = 0
+        self.anchorTick = 0
+        self.anchorTime = None
+
+        # Late tick reporting
+        self.lateTicks = 0
+        self.maxLateness = 0.0
+        self.lastLateness = 0.0
+
+    # Deadline (monotonic clock) of a tick
+    def deadline(self, tick):
+        return self.anchorTime + (tick - self.anchorTick) * self.period
+
+    # Change the tempo while playing. Can be called from any thread; takes effect from the
+    # next tick that hasn't been handed out yet.
+    def setPeriod(self, period):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        with self.lock:
+            if self.anchorTime is not None:
+                self.anchorTime = self.deadline(self.tick)
+                self.anchorTick = self.tick
+            self.period = period
+
+    # Deadline of the next tick. Starts the schedule on the first call.
+    def next(self):
+        with self.lock:
+            if self.anchorTime is None:
+                self.anchorTime = time.monotonic() + self.latency
+                self.anchorTick = self.tick
+            return self.deadline(self.tick)
+
+    # Seconds to wait before sending the tick with this deadline
+    def delay(self, deadline):
+        return max(0.0, deadline - self.latency - time.monotonic())
+
+    # Mark the tick with this deadline as sent and return its (possibly new) deadline.
+    # A tick that is more than a whole period late is played right away and the schedule
+    # is restarted from it, rather than rushing through the missed ticks.
+    def sent(self, deadline):
+        now = time.monotonic()
+        lateness = now - (deadline - self.latency)
+        self.lastLateness = lateness
+        if lateness > self.lateThreshold:
+            self.lateTicks += 1
+            self.maxLateness = max(self.maxLateness, lateness)
+
+        with self.lock:
+            if lateness > self.period:
+                self.anchorTime = now + self.latency
+                self.anchorTick = self.tick
+                deadline = self.anchorTime
+            self.tick += 1
+        return deadline
+
+    # Sleep until it is time to send the next tick and return that tick's deadline
+    def wait(self):
+        deadline = self.next()
+        seconds = self.delay(deadline)
+        if seconds > 0:
+            time.sleep(seconds)
+        return self.sent(deadline)
+
+    # Wall clock time (seconds since the epoch, as used for OSC timetags) of a deadline
+    def timetag(self, deadline):
+        return time.time() + (deadline - time.monotonic())
@@ -0,0 +1,124 @@
+"""
+Telemetry for the OSC playback loops, replacing the status lines printed on every tick.
+
+Printing to the terminal inside the timing-critical loop blocks whenever stdout is slow
+(over SSH, or piped to a log) and makes the sound stutter. Instead, the loop only updates
+a few counters and hands log records to a queue. A background thread (a logging
+QueueListener) drains the queue and does the actual writing.
+
+Log levels:
+    DEBUG    one status line per tick (what the scripts used to print)
+    INFO     a rate-limited status line with the counters, every `interval` seconds
+    WARNING  only reports of late ticks (at most once per interval)
+
+Brian Cantrell, Worldbuilding Media Lab.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+#################################################################################
+# GLOBAL VARIABLES ##############################################################
+logger = logging.getLogger("wiac")
+listener = None # QueueListener writing the log records in the background
+
+#################################################################################
+# Route the "wiac" logger through a queue drained by a background thread
+def setup(level="INFO", stream=None):
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(stop)
+
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+# Flush the queue and stop the background thread
+def stop():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+#################################################################################
+# Counters for one playback loop (or one stream of the engine)
+class Telemetry(object):
+    def __init__(self, name="", interval=1.0, lateThreshold=0.005):
+        self.name = name
+        self.interval = interval            # Seconds between INFO status lines
+        self.lateThreshold = lateThreshold  # Seconds behind schedule that count as late
+        self.ticks = 0
+        self.totalDuration = 0.0
+        self.maxDuration = 0.0
+        self.lateTicks = 0
+        self.maxLateness = 0.0
+        self.reportedLate = 0
+        self.nextReport = time.monotonic() + interval
+
+    # Record one tick. duration is the time spent building and sending it, lateness how far
+    # behind schedule it was sent. status is a function returning the status line (e.g. an
+    # oscengine.Stream's status method) and is only called when the line will be logged.
+    def tick(self, duration, lateness=0.0, status=None):
+        self.ticks += 1
+        self.totalDuration += duration
+        if duration > self.maxDuration:
+            self.maxDuration = duration
+        if lateness > self.lateThreshold:
+            self.lateTicks += 1
+            if lateness > self.maxLateness:
+                self.maxLateness = lateness
+
+        if status is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s%s", self.prefix(), status())
+
+        now = time.monotonic()
+        if now >= self.nextReport:
+            self.nextReport = now + self.interval
+            self.report(status)
+
+    def prefix(self):
+        return self.name + "  " if self.name else ""
+
+    # Log the counters (INFO) and any new late ticks (WARNING)
+    def report(self, status=None):
+        if self.lateTicks > self.reportedLate:
+            logger.warning("%s%d late tick(s) since the last report (%d total, worst %.1f ms)",
+                    self.prefix(), self.lateTicks - self.reportedLate, self.lateTicks,
+                    self.maxLateness * 1000)
+            self.reportedLate = self.lateTicks
+        if logger.isEnabledFor(logging.INFO):
+            line = "%sticks %d  mean %.3f ms  max %.3f ms  late %d" % (self.prefix(), self.ticks,
+                    self.meanDuration() * 1000, self.maxDuration * 1000, self.lateTicks)
+            if status is not None:
+                line += "  |  " + status()
+            logger.info(line)
+
+    def meanDuration(self):
+        return self.totalDuration / self.ticks if self.ticks else 0.0
+
+    # The counters as a dict
+    def counters(self):
+        return {
+            "ticks": self.ticks,
+            "meanDuration": self.meanDuration(),
+            "maxDuration": self.maxDuration,
+            "lateTicks": self.lateTicks,
+            "maxLateness": self.maxLateness,
+        }
+
+    # Final summary, e.g. when playback is stopped
+    def summary(self):
+        logger.warning("%s%d ticks sent, mean %.3f ms, max %.3f ms per tick, %d late (worst %.1f ms)",
+                self.prefix(), self.ticks, self.meanDuration() * 1000, self.maxDuration * 1000,
+                self.lateTicks, self.maxLateness * 1000)